@@ -9,7 +9,9 @@
 # 'NANOG traceroute' ('traACESroute'). See
 # ftp://ftp.aces.com/pub/software/traceroute/ for details.
 
-import sys, socket, re, pprint, getopt, os, errno
+import sys, socket, re, pprint, getopt, os, errno, collections, asyncio
+import mmap, struct, array, bisect, gzip, sqlite3, time, json, stat, signal
+import concurrent.futures
 
 BUF_SZ = 8192
 
@@ -17,8 +19,52 @@ RA_SERVER  = 'whois.ra.net'
 RA_SERVICE = '43' ## 'whois'
 DATA_DELIM = 'origin:'
 RT_DELIM   = 'route:'
+RT6_DELIM  = 'route6:'
 PFX_DELIM  = '/'
 
+## names, including the whois server's, are resolved once per DNS_TTL seconds;
+## a batch's over DNS_THREADS threads at once
+DNS_TTL     = 300
+DNS_THREADS = 32
+
+## IRRd persistent session: after '!!' the connection stays open across
+## queries, and '!r<prefix>,L' returns all covering route objects framed as
+## 'A<length>\n<data>C\n', or 'C\n' (none), 'D\n' (not found), 'F <error>\n'
+IRR_PERSIST = '!!'
+IRR_ROUTES  = '!r%s,L'
+IRR_MORE    = '!r%s,M'
+IRR_QUIT    = '!q'
+IRR_DEPTH   = 64 ## queries in flight
+IRR_CONNS   = 4  ## most connections opened by the asyncio engine
+
+## routes learned are cached in a trie. A miss also fetches all routes within
+## the enclosing block, the best route or the /TRIE_BLOCK containing the name if
+## that is longer, so that later names in the block are answered exactly
+TRIE_BLOCK  = 16
+TRIE_BLOCK6 = 48 ## for IPv6, the longest prefix generally routed
+
+## ...and, given a cache file, persisted between runs: blocks filled are kept
+## with the routes within and covering them for CACHE_TTL seconds, evicting
+## the least recently fetched beyond CACHE_SIZE blocks
+CACHE_TTL   = 7 * 86400
+CACHE_SIZE  = 1 << 16
+
+## a batch is planned before it is looked up: names are resolved, and each
+## distinct query made once, fetching whole any IPv4 or IPv6 block of these
+## lengths that holds more than one
+AGGREGATE   = { 32: 24, 128: 48 }
+
+## offline index compiled from RPSL dumps, eg., ftp://ftp.radb.net/radb/dbase/
+## radb.db.gz: a header, then native uint32 arrays per family, IPv6 addresses
+## being 16 byte big-endian strings. Routes are flattened into sorted disjoint
+## segments [start, end], each naming the most specific route covering it;
+## routes hold their parent, the next less specific route, and their origins
+## as a slice of one shared array
+IDX_MAGIC = b'IP2ASI2' + (b'<' if sys.byteorder == 'little' else b'>')
+IDX_HDR   = struct.Struct('=8sIIIII') ## magic, IPv4 segments and routes, IPv6
+                                      ## segments and routes, origins
+IDX_NONE  = 0xffffffff
+
 def die_with_usage(err="", code=0):
 
     print("""ERROR: %s
@@ -28,17 +74,49 @@ Usage: %s [ options ] <names> where [options] are:
     -v|--verbose : Be verbose
     -V|--VERBOSE : Be very verbose
 
-    -n|--natural : Force natural masks for old-style lookups
+    -n|--natural : Force natural masks for old-style IPv4 lookups
+    -w|--whois <server[:port]>
+                 : Query this whois server [%s:%s]
+    -i|--input <file>
+                 : Read names from file, one per line
+    -1|--oneshot : Connect per query, for servers without IRRd '!' commands
+    -c|--concurrency <n>
+                 : Look up n names at a time using asyncio
+    -C|--nocache : Query the server for every distinct name, not caching
+                   or aggregating routes
+    -a|--aggregate <len[,len6]>
+                 : Fetch IPv4 (IPv6) blocks of this length, if they hold
+                   more than one query; 0 not to [%d,%d]
+    -k|--cache <file>
+                 : Keep cached routes in this SQLite database between runs
+    -t|--ttl <seconds>
+                 : Refetch cached routes older than this [%d]
+    -m|--cachesize <n>
+                 : Keep at most n blocks of routes in the cache [%d]
+    -b|--build <dump>
+                 : Compile RPSL dump(s), optionally gzipped, into the index
+    -d|--db <index>
+                 : Look up names offline in the index, not the server
+    -s|--serve <path|[host:]port>
+                 : Serve lookups to local clients over a Unix socket or TCP,
+                   one name or JSON list of names per line
 
-    Resolves the given names to their addresses and owning ASs.""" % (
-              err, os.path.basename(sys.argv[0]),),
+    Resolves the given names to their IPv4 or IPv6 addresses and owning
+    ASs.""" % (
+              err, os.path.basename(sys.argv[0]), RA_SERVER, RA_SERVICE,
+              AGGREGATE[32], AGGREGATE[128], CACHE_TTL, CACHE_SIZE),
           file=sys.stderr)
     sys.exit(code)
 
+## address width in bits, IPv6 addresses being those with a ':'
+def width(s):
+    return 128 if ':' in s else 32
+
 def pfx2id(s):
     pfx, plen = s.split('/')
-    pfx = list(map(int, pfx.split('.')))
     plen = int(plen)
+    if ':' in pfx: return (str2id(pfx), plen)
+    pfx = list(map(int, pfx.split('.')))
 
     p = 0
     for i in range(len(pfx)):
@@ -48,68 +126,917 @@ def pfx2id(s):
     return (p, plen)
 
 def str2id(str):
+    if ':' in str:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, str), 'big')
     quads = str.split('.')
     ret   = (int(quads[0]) << 24) + (int(quads[1]) << 16) + \
             (int(quads[2]) <<  8) + (int(quads[3]) <<  0)
     return ret
 
-def id2str(id):
+def id2str(id, bits=32):
+    if bits == 128:
+        return socket.inet_ntop(socket.AF_INET6, id.to_bytes(16, 'big'))
     return "%d.%d.%d.%d" %\
            (int( ((id & 0xff000000) >> 24) & 0xff),
             int( ((id & 0x00ff0000) >> 16) & 0xff),
             int( ((id & 0x0000ff00) >>  8) & 0xff),
             int( (id  & 0x000000ff)        & 0xff) )
 
+## an RPSL object's lines into a dict of attribute lists, continuation lines
+## adding to the last; any non-ASCII bytes in values are replaced
+FLD_RE = re.compile(rb'(^[a-z][a-z0-9-]*:){0,1}(.*)')
+END_RE = re.compile(rb'\n\r?\n')
+
+def rpsl_object(entry):
+    if VERBOSE > 2: pprint.pprint(entry)
+    rv = {}
+    last_key = None
+    for line in entry.split(b'\n'):
+        m = FLD_RE.match(line)
+        if m.group(1):
+            key = m.group(1)[:-1].decode('ascii')   # remove trailing ':'
+            last_key = key
+        else:
+            key = last_key
+
+        val = m.group(2).strip().decode('ascii', 'replace')
+        try: rv[key].append(val)
+        except KeyError: rv[key] = [val]
+    return rv
+
+## incremental parser: feed() it replies as they arrive, returning each object
+## as soon as the blank line ending it does; close() returns any last one
+class RPSL:
+    def __init__(self):
+        self.buf = bytearray()
+        self.scan = 0 ## where the next blank line may start
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        rvs = []
+        start = 0
+        m = END_RE.search(buf, self.scan)
+        while m:
+            entry = bytes(buf[start:m.start()]).strip()
+            if entry: rvs.append(rpsl_object(entry))
+            start = m.end()
+            m = END_RE.search(buf, start)
+        del buf[:start]
+        self.scan = max(0, len(buf) - 2)
+        return rvs
+
+    def close(self):
+        entry = bytes(self.buf).strip()
+        self.buf.clear()
+        self.scan = 0
+        return [ rpsl_object(entry) ] if entry else []
+
+## parse a whole reply of RPSL objects, separated by blank lines
+def rpsl(reply):
+    p = RPSL()
+    return p.feed(reply) + p.close()
+
+## the prefixes of an RPSL route or route6 object
+def rv_routes(rv):
+    return rv.get('route', []) + rv.get('route6', [])
+
+## names resolved, each to its IPv4 address if it has one, else IPv6
+class Resolver:
+    def __init__(self, ttl=DNS_TTL, threads=DNS_THREADS):
+        self.ttl = ttl
+        self.addrs = {}  ## name: (address, or None if it failed, expiry)
+        self.errors = {} ## name: why it last failed
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def cached(self, name):
+        return self.addrs.get(name, (None, 0))[1] > time.time()
+
+    ## a name's address, or None, having recorded why, if it cannot be resolved
+    def resolve(self, name):
+        if self.cached(name): return self.addrs[name][0]
+        try:
+            try:
+                addr = socket.gethostbyname(name)
+            except socket.gaierror:
+                ai = socket.getaddrinfo(name, None, family=socket.AF_INET6,
+                                        type=socket.SOCK_STREAM)
+                addr = ai[0][4][0]
+            self.errors.pop(name, None)
+        except (OSError, ValueError) as err:
+            addr = None
+            self.errors[name] = err
+        if VERBOSE > 2: print('resolved: %s %s' % (name, addr))
+        self.addrs[name] = (addr, time.time() + self.ttl)
+        return addr
+
+    async def aresolve(self, name):
+        if self.cached(name): return self.addrs[name][0]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, self.resolve, name)
+
+    ## a server's address, raising why if it cannot be resolved
+    def server(self, name):
+        addr = self.resolve(name)
+        if addr is None: raise self.errors[name]
+        return addr
+
+    async def aserver(self, name):
+        addr = await self.aresolve(name)
+        if addr is None: raise self.errors[name]
+        return addr
+
+    ## resolve, concurrently, any of names not cached
+    def resolve_all(self, names):
+        names = [ n for n in dict.fromkeys(names) if not self.cached(n) ]
+        for _ in self.pool.map(self.resolve, names): pass
+
+    async def aresolve_all(self, names):
+        await asyncio.gather(*[
+            self.aresolve(n) for n in dict.fromkeys(names)
+            if not self.cached(n) ])
+
+RESOLVER = Resolver()
+
+## one connection per query, plain whois
 def lookup(net):
-    rvs = []
-    ra_addr = socket.gethostbyname(RA_SERVER)
+    ra_addr = RESOLVER.server(RA_SERVER)
     if VERBOSE > 2: print("ra_addr:", ra_addr)
-    so = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
     sp = int(RA_SERVICE) ## socket.getservbyname(RA_SERVICE, 'tcp')
 
-    so.connect((ra_addr, sp))
+    so = socket.create_connection((ra_addr, sp))
     so.send(bytes(net + '\r\n', 'ascii'))
 
-    reply = ''
+    rvs = []
+    parser = RPSL()
     while 1:
         rbuf = so.recv(BUF_SZ)
         if len(rbuf) == 0: break;
-        reply += rbuf.decode('ascii')
-
-    if VERBOSE > 2: pprint.pprint(reply)
-
-    reply = reply.strip().split('\n\n')
-    for entry in reply:
-        entry = entry.split('\n')
-
-        rv = {}
-        last_key = None
-        fld_re = re.compile('(^[a-z-]+:){0,1}(.*)')
-        for line in entry:
-            m = fld_re.match(line)
-            if m:
-                if m.group(1):
-                    key = m.group(1)[:-1]   # remove trailing ':'
-                    last_key = key
-                else:
-                    key = last_key
-
-                val = m.group(2).strip()
-                try: rv[key].append(val)
-                except: rv[key] = [val]
-        rvs.append(rv)
+        rvs.extend(parser.feed(rbuf))
+    rvs.extend(parser.close())
+    so.close()
 
     return rvs
 
+## persistent IRRd session, resolving and connecting once. Queries are
+## pipelined, up to IRR_DEPTH ahead of the replies, which arrive in order
+class Whois:
+    def __init__(self, server=RA_SERVER, port=RA_SERVICE):
+        self.server = server
+        self.port = port
+        ra_addr = RESOLVER.server(server)
+        if VERBOSE > 2: print("ra_addr:", ra_addr)
+        self.so = socket.create_connection((ra_addr, int(port)))
+        self.rf = self.so.makefile('rb')
+        self.so.sendall(bytes(IRR_PERSIST + '\n', 'ascii'))
+
+    def _send(self, q):
+        self.so.sendall(bytes(q + '\n', 'ascii'))
+
+    def _reply(self):
+        n = irr_length(self.server, self.rf.readline())
+        if not n: return []
+        rvs = []
+        parser = RPSL()
+        while n > 0:
+            rbuf = self.rf.read1(min(n, BUF_SZ))
+            if not rbuf:
+                raise socket.error("%s: connection closed" % self.server)
+            n -= len(rbuf)
+            rvs.extend(parser.feed(rbuf))
+        rvs.extend(parser.close())
+        if self.rf.readline() != b'C\n':
+            raise socket.error("%s: bad reply framing" % self.server)
+        return rvs
+
+    ## yields the routes covering each prefix, in order
+    def lookups(self, pfxs, q=IRR_ROUTES):
+        pending = 0
+        for pfx in pfxs:
+            self._send(q % pfx)
+            pending += 1
+            if pending == IRR_DEPTH:
+                yield self._reply()
+                pending -= 1
+        for _ in range(pending):
+            yield self._reply()
+
+    def lookup(self, pfx, q=IRR_ROUTES):
+        return next(self.lookups([pfx], q))
+
+    def close(self):
+        try: self._send(IRR_QUIT)
+        except socket.error: pass
+        self.rf.close()
+        self.so.close()
+
+## length of the data following an IRRd reply's status line, if any
+def irr_length(server, line):
+    if not line.endswith(b'\n'):
+        raise socket.error("%s: connection closed" % server)
+    if line[:1] == b'A':
+        return int(line[1:])
+    if line[:1] == b'F':
+        sys.stderr.write('%s: %s\n' % (
+            server, line[1:].decode('ascii', 'replace').strip()))
+    return 0
+
+## the same session under asyncio, shared by concurrent lookup()s: each sends
+## its query and queues a future, resolved in order as replies arrive
+class AsyncWhois:
+    @classmethod
+    async def open(cls, server, ra_addr, port):
+        self = cls()
+        self.server = server
+        self.reader, self.writer = await asyncio.open_connection(
+            ra_addr, int(port))
+        self.writer.write(bytes(IRR_PERSIST + '\n', 'ascii'))
+        self.depth = asyncio.Semaphore(IRR_DEPTH)
+        self.waiting = collections.deque()
+        self.replies = asyncio.ensure_future(self._replies())
+        return self
+
+    async def _replies(self):
+        try:
+            while 1:
+                n = n0 = irr_length(self.server, await self.reader.readline())
+                rvs = []
+                parser = RPSL()
+                while n > 0:
+                    rbuf = await self.reader.read(min(n, BUF_SZ))
+                    if not rbuf:
+                        raise socket.error(
+                            "%s: connection closed" % self.server)
+                    n -= len(rbuf)
+                    rvs.extend(parser.feed(rbuf))
+                rvs.extend(parser.close())
+                if n0 and await self.reader.readline() != b'C\n':
+                    raise socket.error("%s: bad reply framing" % self.server)
+                f = self.waiting.popleft()
+                if not f.done(): f.set_result(rvs)
+        except Exception as e:
+            for f in self.waiting:
+                if not f.done(): f.set_exception(e)
+
+    ## fails if the session has closed, perhaps while waiting for the depth
+    ## semaphore, as no reply would ever come
+    async def lookup(self, pfx, q=IRR_ROUTES):
+        async with self.depth:
+            if self.replies.done():
+                raise socket.error("%s: connection closed" % self.server)
+            f = asyncio.get_running_loop().create_future()
+            self.waiting.append(f)
+            self.writer.write(bytes(q % pfx + '\n', 'ascii'))
+            return await f
+
+    async def close(self):
+        self.writer.write(bytes(IRR_QUIT + '\n', 'ascii'))
+        self.replies.cancel()
+        self.writer.close()
+
+## binary radix trie of route objects by prefix; a node is [child0, child1,
+## routes, fetched], every route within it being known if it was fetched, as
+## a block, within the TTL
+class Trie:
+    def __init__(self, cache=None, ttl=CACHE_TTL):
+        self.roots = { 32: [None, None, [], 0],
+                       128: [None, None, [], 0] }
+        self.ttl = ttl
+        self.cache = None
+        if cache:
+            for block, fetched, rvs in cache.blocks():
+                self.fill(block, rvs, fetched)
+        self.cache = cache
+
+    def _node(self, addr, plen, bits):
+        n = self.roots[bits]
+        for i in range(plen):
+            b = (addr >> (bits - 1 - i)) & 1
+            if n[b] is None: n[b] = [None, None, [], 0]
+            n = n[b]
+        return n
+
+    def insert(self, rvs):
+        for rv in rvs:
+            if None in rv: continue
+            for rt in rv_routes(rv):
+                addr, plen = pfx2id(rt)
+                routes = self._node(addr, plen, width(rt))[2]
+                if rv not in routes: routes.append(rv)
+
+    ## all routes covering addr/plen, or None if some may be unknown, or only
+    ## known from a block since expired
+    def get(self, addr, plen, bits=32):
+        stale = time.time() - self.ttl
+        n = self.roots[bits]
+        rvs = list(n[2])
+        complete = n[3] > stale
+        for i in range(plen):
+            n = n[(addr >> (bits - 1 - i)) & 1]
+            if n is None: break
+            rvs.extend(n[2])
+            complete = complete or n[3] > stale
+        return rvs if complete else None
+
+    ## the block to fill after a miss for addr/plen answered by rvs, if any
+    def block(self, addr, plen, rvs, bits=32):
+        blen = TRIE_BLOCK if bits == 32 else TRIE_BLOCK6
+        for rv in rvs:
+            if None in rv: continue
+            for rt in rv_routes(rv):
+                if width(rt) == bits: blen = max(blen, pfx2id(rt)[1])
+        if blen > plen: return None
+        return '%s/%d' % (
+            id2str(addr & pow(2, bits) - pow(2, bits-blen), bits), blen)
+
+    ## insert all routes within and covering pfx, as fetched then, replacing
+    ## any within it from before
+    def fill(self, pfx, rvs, fetched=None):
+        addr, plen = pfx2id(pfx)
+        n = self._node(addr, plen, width(pfx))
+        n[:3] = [None, None, []]
+        self.insert(rvs)
+        n[3] = fetched or time.time()
+        if self.cache: self.cache.put(pfx, rvs)
+
+## blocks filled, and their routes, in SQLite; changes are committed, and the
+## cache trimmed to size, on commit() and close()
+class Cache:
+    def __init__(self, path, ttl=CACHE_TTL, size=CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS blocks (
+                block TEXT PRIMARY KEY, fetched REAL);
+            CREATE TABLE IF NOT EXISTS routes (
+                block TEXT, route TEXT, origins TEXT);
+            CREATE INDEX IF NOT EXISTS routes_block ON routes (block);
+        ''')
+
+    ## yields (block, fetched, routes) for each block fetched within the TTL
+    def blocks(self):
+        stale = time.time() - self.ttl
+        self.db.execute('DELETE FROM routes WHERE block IN '
+                        '(SELECT block FROM blocks WHERE fetched < ?)',
+                        (stale,))
+        self.db.execute('DELETE FROM blocks WHERE fetched < ?', (stale,))
+
+        n = 0
+        block, fetched, rvs = None, 0, []
+        for b, f, route, origins in self.db.execute(
+                'SELECT block, fetched, route, origins FROM blocks '
+                'LEFT JOIN routes USING (block) ORDER BY block, routes.rowid'):
+            if b != block:
+                if block: yield (block, fetched, rvs)
+                block, fetched, rvs = b, f, []
+                n += 1
+            if route:
+                key = 'route' if width(route) == 32 else 'route6'
+                rvs.append({key: [route], 'origin': origins.split()})
+        if block: yield (block, fetched, rvs)
+        if VERBOSE > 1: print('cache: %d blocks' % n)
+
+    def put(self, block, rvs):
+        rows = {}
+        for rv in rvs:
+            if None in rv: continue
+            for rt in rv_routes(rv):
+                rows[block, rt, ' '.join(rv.get('origin', []))] = None
+        self.db.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?)',
+                        (block, time.time()))
+        self.db.execute('DELETE FROM routes WHERE block = ?', (block,))
+        self.db.executemany('INSERT INTO routes VALUES (?, ?, ?)', rows)
+
+    ## evicting the least recently fetched blocks beyond size
+    def commit(self):
+        n, = self.db.execute('SELECT COUNT(*) FROM blocks').fetchone()
+        if n > self.size:
+            self.db.execute('DELETE FROM blocks WHERE block NOT IN '
+                            '(SELECT block FROM blocks '
+                            ' ORDER BY fetched DESC LIMIT ?)', (self.size,))
+            self.db.execute('DELETE FROM routes WHERE block NOT IN '
+                            '(SELECT block FROM blocks)')
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+## route or route6, and origin attributes of each object in an RPSL dump
+def rpsl_routes(f):
+    route, origins = None, []
+    for line in f:
+        if line.startswith(RT_DELIM):
+            route = line[len(RT_DELIM):].strip()
+        elif line.startswith(RT6_DELIM):
+            route = line[len(RT6_DELIM):].strip()
+        elif line.startswith(DATA_DELIM):
+            origins.append(line[len(DATA_DELIM):].strip())
+        elif not line.strip():
+            if route: yield (route, origins)
+            route, origins = None, []
+    if route: yield (route, origins)
+
+## IPv6 addresses in an index as a sequence of ints, for bisect
+class Addrs6:
+    def __init__(self, mv):
+        self.mv = mv
+
+    def __len__(self):
+        return len(self.mv) // 16
+
+    def __getitem__(self, i):
+        return int.from_bytes(self.mv[16*i:16*i + 16], 'big')
+
+IndexTable = collections.namedtuple('IndexTable', [
+    'seg_start', 'seg_end', 'seg_route',
+    'rt_addr', 'rt_plen', 'rt_parent', 'rt_origins' ])
+
+class Index:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nsegs, nroutes, nsegs6, nroutes6, norigins = \
+            IDX_HDR.unpack_from(self._mm)
+        if magic != IDX_MAGIC: raise ValueError("%s: not an index" % path)
+
+        mv = memoryview(self._mm)
+        off = IDX_HDR.size
+        def take(n, fmt='I'):
+            nonlocal off
+            a = mv[off:off + 4*n].cast(fmt)
+            off += 4*n
+            return a
+        def take6(n):
+            return Addrs6(take(4*n, 'B'))
+        self.tables = {}
+        for bits, nsegs, nroutes, addrs in ((32, nsegs, nroutes, take),
+                                            (128, nsegs6, nroutes6, take6)):
+            self.tables[bits] = IndexTable(
+                addrs(nsegs), addrs(nsegs), take(nsegs),
+                addrs(nroutes), take(nroutes), take(nroutes),
+                take(nroutes + 1))
+        self.origins = take(norigins)
+
+    ## the best routes covering addr/plen, as rpsl() would parse them
+    def lookup(self, addr, plen, bits=32):
+        t = self.tables[bits]
+        i = bisect.bisect_right(t.seg_start, addr) - 1
+        if i < 0 or t.seg_end[i] < addr: return []
+        r = t.seg_route[i]
+        while r != IDX_NONE and t.rt_plen[r] > plen:
+            r = t.rt_parent[r]
+        if r == IDX_NONE: return []
+        route = '%s/%d' % (id2str(t.rt_addr[r], bits), t.rt_plen[r])
+        key = 'route' if bits == 32 else 'route6'
+        return [ {key: [route], 'origin': ['AS%d' % self.origins[o]]}
+                 for o in range(t.rt_origins[r], t.rt_origins[r+1]) ]
+
+    ## disjoint segments of the sorted routes keys, and each route's parent
+    @staticmethod
+    def segments(keys, bits):
+        ## outer routes sort before the inner routes they contain; sweep,
+        ## keeping the stack of routes covering the current position
+        seg_start, seg_end, seg_route = [], [], []
+        parent = []
+        stack = []
+        pos = 0
+        def close(upto):
+            nonlocal pos
+            while stack and (upto is None or stack[-1][1] < upto):
+                r, end = stack.pop()
+                if pos <= end:
+                    seg_start.append(pos)
+                    seg_end.append(end)
+                    seg_route.append(r)
+                    pos = end + 1
+        for r, (addr, plen) in enumerate(keys):
+            close(addr)
+            if stack and pos < addr:
+                seg_start.append(pos)
+                seg_end.append(addr - 1)
+                seg_route.append(stack[-1][0])
+            parent.append(stack[-1][0] if stack else IDX_NONE)
+            stack.append((r, addr + pow(2, bits-plen) - 1))
+            pos = addr
+        close(None)
+        return (seg_start, seg_end, seg_route, parent)
+
+    @staticmethod
+    def build(dumps, path):
+        routes = { 32: {}, 128: {} }
+        for dump in dumps:
+            with (gzip.open if dump.endswith('.gz') else open)(
+                    dump, 'rt', encoding='latin-1') as f:
+                for route, origins in rpsl_routes(f):
+                    try:
+                        bits = width(route)
+                        addr, plen = pfx2id(route)
+                        ass = [ int(o[2:]) for o in origins
+                                if o[:2].upper() == 'AS' and o[2:].isdigit() ]
+                    except (ValueError, OSError):
+                        continue
+                    if not 0 <= plen <= bits: continue
+                    addr &= pow(2, bits) - pow(2, bits-plen)
+                    rt = routes[bits].setdefault((addr, plen), [])
+                    rt.extend(a for a in ass if a not in rt)
+
+        origins = []
+        tables = []
+        for bits in (32, 128):
+            keys = sorted(routes[bits])
+            rt_origins = [ len(origins) ]
+            for k in keys:
+                origins.extend(routes[bits][k])
+                rt_origins.append(len(origins))
+            tables.append((bits, keys, Index.segments(keys, bits), rt_origins))
+
+        def addrs(f, a, bits):
+            if bits == 32: array.array('I', a).tofile(f)
+            else: f.write(b''.join(x.to_bytes(16, 'big') for x in a))
+
+        with open(path, 'wb') as f:
+            counts = [ n for _, keys, segs, _ in tables
+                       for n in (len(segs[0]), len(keys)) ]
+            f.write(IDX_HDR.pack(IDX_MAGIC, *counts, len(origins)))
+            for bits, keys, (seg_start, seg_end, seg_route, parent), \
+                    rt_origins in tables:
+                addrs(f, seg_start, bits)
+                addrs(f, seg_end, bits)
+                array.array('I', seg_route).tofile(f)
+                addrs(f, [ k[0] for k in keys ], bits)
+                for a in ([ k[1] for k in keys ], parent, rt_origins):
+                    array.array('I', a).tofile(f)
+            array.array('I', origins).tofile(f)
+        return sum(len(keys) for _, keys, _, _ in tables)
+
+## (name, address, query network, prefix length) for a resolved name, or
+## (name, None, None, None) for one that could not be
+def query(ip_str, ip_addr):
+    if ip_addr is None: return (ip_str, None, None, None)
+    bits = width(ip_addr)
+    if  '/' not in ip_str:
+        addr = str2id(ip_addr)
+        plen = bits
+    else:
+        addr, plen = pfx2id(ip_str)
+        addr = addr & pow(2, bits) - pow(2, bits-plen)
+
+    if FORCE_NATURAL_MASK and bits == 32:
+        if ((addr & 0xff000000) >> 24) >= 192:
+            net = id2str(addr & 0xffffff00)
+            plen = 24
+        elif ((addr & 0xff000000) >> 24) >= 128:
+            net = id2str(addr & 0xffff0000)
+            plen = 16
+        else:
+            net = id2str(addr & 0xff000000)
+            plen = 8
+    else: net = id2str(addr, bits)
+
+    if VERBOSE > 1: print('query string:', net)
+    return (ip_str, ip_addr, net, plen)
+
+## whether a name is to be resolved, not being an address or prefix
+def hostname(ip_str):
+    if '/' in ip_str or ':' in ip_str: return False
+    try: socket.inet_pton(socket.AF_INET, ip_str)
+    except OSError: return True
+    return False
+
+## a name's address, IPv4 if it has one, else IPv6, or None
+def resolve(ip_str):
+    return RESOLVER.resolve(ip_str) if hostname(ip_str) else ip_str
+
+## ...per name, first resolving all at once
+def queries(names):
+    names = list(names)
+    RESOLVER.resolve_all(n for n in names if hostname(n))
+    for ip_str in names:
+        yield query(ip_str, resolve(ip_str))
+
+## ...the same, under asyncio
+async def aqueries(names):
+    names = list(names)
+    await RESOLVER.aresolve_all(n for n in names if hostname(n))
+    return [ query(ip_str, resolve(ip_str)) for ip_str in names ]
+
+## a batch of queries: the distinct queries, in order, and the blocks holding
+## more than one of them; answer() fans the routes for each back out. Names
+## that could not be resolved are answered by None as soon as they are reached
+class Plan:
+    def __init__(self, qs, aggregate=None):
+        self.qs = list(qs)
+        self.answers = { (None, None): None }
+        self.done = 0
+
+        distinct = {}
+        for q in self.qs:
+            if q[1] is not None: distinct.setdefault(q[2:], q)
+        self.queries = list(distinct.values())
+
+        counts = collections.Counter()
+        for net, plen in distinct:
+            bits = width(net)
+            blen = aggregate[bits] if aggregate else 0
+            if blen and plen > blen:
+                addr = str2id(net) & pow(2, bits) - pow(2, bits-blen)
+                counts['%s/%d' % (id2str(addr, bits), blen)] += 1
+        self.blocks = [ block for block, n in counts.items() if n > 1 ]
+        if VERBOSE > 1:
+            print('plan: %d names, %d queries, %d blocks' % (
+                len(self.qs), len(self.queries), len(self.blocks)))
+
+    ## the routes for query q, yielding (query, routes) for each name answered
+    ## by them, or before them, in input order
+    def answer(self, q, rvs):
+        self.answers[q[2:]] = rvs
+        return self.answered()
+
+    ## ...and for each name answered but not yet yielded, as any left once all
+    ## queries are answered
+    def answered(self):
+        while (self.done < len(self.qs)
+               and self.qs[self.done][2:] in self.answers):
+            q = self.qs[self.done]
+            self.done += 1
+            yield (q, self.answers[q[2:]])
+
+## looks up queries over a persistent session, yielding (query, routes) in
+## order; blocks are first fetched whole into the trie, and queries the trie
+## can answer are not sent
+def lookups(qs, whois, trie=None, blocks=()):
+    if trie:
+        blocks = [ b for b in blocks
+                   if trie.get(*pfx2id(b), width(b)) is None ]
+        covering = list(whois.lookups(blocks))
+        for block, rvs, more in zip(
+                blocks, covering, whois.lookups(blocks, IRR_MORE)):
+            trie.fill(block, rvs + more)
+
+    ## queries are sent ahead of the replies, so remember what each was for,
+    ## and the answer if already known
+    pending = collections.deque()
+    def pfxs():
+        for q in qs:
+            rvs = trie.get(str2id(q[2]), q[3], width(q[2])) if trie else None
+            if VERBOSE > 1 and rvs is not None: print('cached:', q[0])
+            pending.append((q, rvs))
+            if rvs is None: yield '%s/%d' % (q[2], q[3])
+
+    filler = None
+    for rvs in whois.lookups(pfxs()):
+        while pending[0][1] is not None: yield pending.popleft()
+        q, _ = pending.popleft()
+        if trie:
+            addr, bits = str2id(q[2]), width(q[2])
+            trie.insert(rvs)
+            block = trie.block(addr, q[3], rvs, bits)
+            if block and trie.get(addr, q[3], bits) is None:
+                ## a second session, as this one's replies are queued
+                if filler is None: filler = Whois(whois.server, whois.port)
+                trie.fill(block, rvs + filler.lookup(block, IRR_MORE))
+        yield (q, rvs)
+    while pending: yield pending.popleft()
+    if filler is not None: filler.close()
+
+## lookups over up to IRR_CONNS sessions, shared by concurrent callers; a
+## session found closed is reopened for the next query sent on it
+class AsyncLookups:
+    @classmethod
+    async def open(cls, concurrency, trie=None):
+        self = cls()
+        self.trie = trie
+        ra_addr = await RESOLVER.aserver(RA_SERVER)
+        if VERBOSE > 2: print("ra_addr:", ra_addr)
+        self.conns = await asyncio.gather(*[
+            AsyncWhois.open(RA_SERVER, ra_addr, RA_SERVICE)
+            for _ in range(min(IRR_CONNS, -(-concurrency // IRR_DEPTH))) ])
+        self.next = 0
+        self.reopening = asyncio.Lock()
+        self.fetching = asyncio.Semaphore(concurrency)
+        self.filling = set()
+        return self
+
+    async def _conn(self):
+        i = self.next = (self.next + 1) % len(self.conns)
+        if self.conns[i].replies.done():
+            async with self.reopening:
+                if self.conns[i].replies.done():
+                    await self.conns[i].close()
+                    self.conns[i] = await AsyncWhois.open(
+                        RA_SERVER, await RESOLVER.aserver(RA_SERVER),
+                        RA_SERVICE)
+        return self.conns[i]
+
+    ## fetch blocks whole into the trie
+    async def fetch(self, blocks):
+        async def one(block):
+            conn = await self._conn()
+            async with self.fetching:
+                rvs, more = await asyncio.gather(
+                    conn.lookup(block), conn.lookup(block, IRR_MORE))
+            self.trie.fill(block, rvs + more)
+
+        if self.trie:
+            await asyncio.gather(*[
+                one(b) for b in blocks
+                if self.trie.get(*pfx2id(b), width(b)) is None ])
+
+    ## the routes covering query q
+    async def lookup(self, q):
+        trie = self.trie
+        addr, bits = str2id(q[2]), width(q[2])
+        rvs = trie.get(addr, q[3], bits) if trie else None
+        if rvs is not None:
+            if VERBOSE > 1: print('cached:', q[0])
+            return rvs
+
+        conn = await self._conn()
+        rvs = await conn.lookup('%s/%d' % (q[2], q[3]))
+        if trie:
+            trie.insert(rvs)
+            block = trie.block(addr, q[3], rvs, bits)
+            if (block and block not in self.filling
+                    and trie.get(addr, q[3], bits) is None):
+                self.filling.add(block)
+                try:
+                    trie.fill(block, rvs + await conn.lookup(block, IRR_MORE))
+                finally:
+                    self.filling.discard(block)
+        return rvs
+
+    async def close(self):
+        for conn in self.conns: await conn.close()
+
+## looks up up to concurrency queries at once, yielding (query, routes) in
+## order, after first fetching blocks
+async def alookups(qs, concurrency, trie=None, blocks=()):
+    lookups = await AsyncLookups.open(concurrency, trie)
+    pending = collections.deque()
+    try:
+        await lookups.fetch(blocks)
+        for q in qs:
+            if len(pending) == concurrency:
+                q0, f = pending.popleft()
+                yield (q0, await f)
+            pending.append((q, asyncio.ensure_future(lookups.lookup(q))))
+            while pending and pending[0][1].done():
+                q0, f = pending.popleft()
+                yield (q0, f.result())
+        while pending:
+            q0, f = pending.popleft()
+            yield (q0, await f)
+    finally:
+        for _, f in pending: f.cancel()
+        await lookups.close()
+
+## the line printed for a name, given the routes covering it, or why it
+## could not be resolved
+def describe(q, rvs):
+    ip_str, ip_addr, net, _ = q
+    if ip_addr is None:
+        err = RESOLVER.errors.get(ip_str)
+        if VERBOSE: return 'name: %s, error: %s' % (ip_str, err)
+        return '%s error: %s' % (ip_str, err)
+    route, ass = best_routes(rvs, ip_str)
+    if VERBOSE:
+        return ('name: %s [%s], route: %s, origin: %s' %
+                (ip_str, net, route, ass))
+    return ' '.join((ip_str, net, route, ass))
+
+## serves lookups over a Unix socket at path, or TCP at [host:]port, to any
+## number of local clients, keeping the trie warm. Each request is a line,
+## either a name, answered by the line printed for it, or a JSON list of
+## names, answered by a JSON list of objects with their name, address,
+## network, route and origin, or name and error for names that could not be
+## resolved; other errors are answered by "error: ..." or {"error": ...}
+## respectively. SIGINT or SIGTERM stops it
+async def serve(where, concurrency, trie=None):
+    lookups = await AsyncLookups.open(concurrency, trie)
+
+    async def answer(names):
+        plan = Plan(await aqueries(names), trie and AGGREGATE)
+        await lookups.fetch(plan.blocks)
+        answered = []
+        for q, rvs in zip(plan.queries, await asyncio.gather(*[
+                lookups.lookup(q) for q in plan.queries ])):
+            answered.extend(plan.answer(q, rvs))
+        answered.extend(plan.answered())
+        if trie and trie.cache: trie.cache.commit()
+        return answered
+
+    async def client(reader, writer):
+        try:
+            while 1:
+                line = await reader.readline()
+                if not line: break
+                line = line.decode('ascii', 'replace').strip()
+                if not line: continue
+
+                batch = line.startswith('[')
+                try:
+                    if not batch:
+                        (q, rvs), = await answer([line])
+                        reply = describe(q, rvs)
+                    else:
+                        names = json.loads(line)
+                        if not all(isinstance(n, str) for n in names):
+                            raise ValueError("not a list of names")
+                        reply = []
+                        for q, rvs in await answer(names):
+                            if q[1] is None:
+                                err = RESOLVER.errors.get(q[0])
+                                reply.append({ 'name': q[0],
+                                               'error': str(err) })
+                                continue
+                            route, ass = best_routes(rvs, q[0])
+                            reply.append({ 'name': q[0], 'address': q[1],
+                                           'net': q[2], 'route': route,
+                                           'origin': ass })
+                        reply = json.dumps(reply)
+                except (ValueError, TypeError, socket.error) as err:
+                    if VERBOSE > 1: print('error:', line, err)
+                    reply = (json.dumps({ 'error': str(err) }) if batch
+                             else 'error: %s' % err)
+                writer.write(bytes(reply + '\n', 'ascii', 'replace'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    ## only a socket, as left by an earlier server, is ever replaced
+    def unlink_socket():
+        if os.path.exists(where) and stat.S_ISSOCK(os.stat(where).st_mode):
+            os.unlink(where)
+
+    host, _, port = where.rpartition(':')
+    try:
+        if port.isdigit():
+            server = await asyncio.start_server(
+                client, host or 'localhost', int(port))
+        else:
+            unlink_socket()
+            server = await asyncio.start_unix_server(client, where)
+        if VERBOSE: print('serving on %s' % where, flush=True)
+
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        async with server: await stop.wait()
+    finally:
+        await lookups.close()
+        if not port.isdigit(): unlink_socket()
+
+# Make sure we only pick the 'best' owners: all those entries
+# who's covering route is as long as the longest covering
+# route
+def best_routes(rvs, ip_str):
+    best_plen = 0
+    best      = []
+    for rv in rvs:
+        if None not in rv:
+            for rt in rv_routes(rv):
+                (pfx, plen) = rt.split('/')
+                plen = int(plen)
+                if plen > best_plen:
+                    best_plen = plen
+                    best = [ rv ]
+                elif plen == best_plen:
+                    if rv not in best: best.append(rv)
+    if len(best) == 0:
+        best = [{'origin': ['UNKNOWN'], 'route': [ip_str]}]
+    ass = []
+    ass.extend(map(lambda x, ass=ass: ass.extend(x['origin']), best))
+    try:
+        while 1:
+            ass.remove(None)
+    except (ValueError):
+        pass
+    ass = '/'.join(ass)
+
+    return (rv_routes(best[0])[0], ass)
+
 if __name__ == '__main__':
 
     FORCE_NATURAL_MASK = 0
+    ONESHOT = 0
+    CONCURRENCY = 0
+    CACHE = 1
+    CACHE_DB = None
+    BUILD = []
+    DB = None
+    SERVE = None
     VERBOSE = 1
     ip_addrs = None
 
     ## option parsing
     pairs = [ "h/help", "q/quiet", "v/verbose", "V/VERBOSE", "n/natural",
-              "w:/whois=", "i:/input=", ]
+              "w:/whois=", "i:/input=", "1/oneshot", "c:/concurrency=",
+              "C/nocache", "a:/aggregate=", "k:/cache=", "t:/ttl=",
+              "m:/cachesize=", "b:/build=", "d:/db=", "s:/serve=", ]
     shortopts = "".join([ pair.split("/")[0] for pair in pairs ])
     longopts = [ pair.split("/")[1] for pair in pairs ]
     try: opts, args = getopt.getopt(sys.argv[1:], shortopts, longopts)
@@ -122,82 +1049,97 @@ if __name__ == '__main__':
             elif o in ('-v', '--verbose'): VERBOSE = 2
             elif o in ('-V', '--VERBOSE'): VERBOSE = 3
             elif o in ('-n', '--natural'): FORCE_NATURAL_MASK = 1
-            elif o in ('-w', '--whois'): RA_SERVER = a
+            elif o in ('-w', '--whois'):
+                RA_SERVER, _, port = a.partition(':')
+                if port: RA_SERVICE = port
+            elif o in ('-1', '--oneshot'): ONESHOT = 1
+            elif o in ('-c', '--concurrency'): CONCURRENCY = int(a)
+            elif o in ('-C', '--nocache'): CACHE = 0
+            elif o in ('-a', '--aggregate'):
+                blen, _, blen6 = a.partition(',')
+                blen = int(blen)
+                ## a lone 0 turns aggregation off for both families
+                if blen6: blen6 = int(blen6)
+                elif blen == 0: blen6 = 0
+                else: blen6 = AGGREGATE[128]
+                AGGREGATE = { 32: blen, 128: blen6 }
+            elif o in ('-k', '--cache'): CACHE_DB = a
+            elif o in ('-t', '--ttl'): CACHE_TTL = int(a)
+            elif o in ('-m', '--cachesize'): CACHE_SIZE = int(a)
+            elif o in ('-b', '--build'): BUILD.append(a)
+            elif o in ('-d', '--db'): DB = a
+            elif o in ('-s', '--serve'): SERVE = a
             elif o in ('-i', '--input'): ip_addrs = open(a)
             else: raise Exception("unhandled option")
 
     except Exception as err: die_with_usage(err, 3)
 
+    if BUILD:
+        if not DB: die_with_usage("--build needs --db!", 4)
+        n = Index.build(BUILD, DB)
+        if VERBOSE: print('%s: %d routes' % (DB, n))
+        if not ip_addrs and not args: sys.exit(0)
+
     if not ip_addrs:
         ip_addrs = args
-        if not ip_addrs: die_with_usage("no addresses!", 4)
+        if not ip_addrs and not SERVE: die_with_usage("no addresses!", 4)
 
-    for ip_str in [ s.strip() for s in ip_addrs ]:
-        try:
-            if  '/' not in ip_str:
-                ip_addr = socket.gethostbyname(ip_str)
-                addr = str2id(ip_addr)
-            else:
-                ip_addr = ip_str
-                addr, plen = pfx2id(ip_str)
-                addr = addr & pow(2, 32) - pow(2, 32-plen)
-
-            if FORCE_NATURAL_MASK:
-                if ((addr & 0xff000000) >> 24) >= 192:
-                    net = id2str(addr & 0xffffff00)
-                elif ((addr & 0xff000000) >> 24) >= 128:
-                    net = id2str(addr & 0xffff0000)
-                else:
-                    net = id2str(addr & 0xff000000)
-            else: net = id2str(addr)
-
-            if VERBOSE > 1: print('query string:', net)
-
-            rvs = lookup(net)
-            if VERBOSE > 1:
-                print(ip_addr, ':')
-                pprint.pprint(rvs)
-
-        except socket.error as error:
-            if len(error.args) == 1:
-                err = 0
-                msg = error.args
-                sys.stderr.write('error: %s\n' % (" ".join(msg),))
-            else:
-                (err, msg) = error.args
-                sys.stderr.write('%s: %s\n' % (os.strerror(err), msg))
-
-            sys.exit(1)
-
-        # Make sure we only pick the 'best' owners: all those entries
-        # who's covering route is as long as the longest covering
-        # route
-
-        best_plen = 0
-        best      = []
-        for rv in rvs:
-            if None not in rv:
-                for rt in rv['route']:
-                    (pfx, plen) = rt.split('/')
-                    plen = int(plen)
-                    if plen > best_plen:
-                        best_plen = plen
-                        best = [ rv ]
-                    elif plen == best_plen:
-                        if rv not in best: best.append(rv)
-        if len(best) == 0:
-            best = [{'origin': ['UNKNOWN'], 'route': [ip_str]}]
-        ass = []
-        ass.extend(map(lambda x, ass=ass: ass.extend(x['origin']), best))
-        try:
-            while 1:
-                ass.remove(None)
-        except (ValueError):
-            pass
-        ass = '/'.join(ass)
+    def report(q, rvs):
+        ip_str, ip_addr, net, _ = q
+        if VERBOSE > 1:
+            print(ip_addr, ':')
+            pprint.pprint(rvs)
+
+        print(describe(q, rvs))
+
+    async def areport(names, trie):
+        plan = Plan(await aqueries(names), trie and AGGREGATE)
+        async for q, rvs in alookups(plan.queries, CONCURRENCY, trie,
+                                     plan.blocks):
+            for a in plan.answer(q, rvs): report(*a)
+        for a in plan.answered(): report(*a)
+
+    cache = None
+    try:
+        names = [ s.strip() for s in ip_addrs ]
+        if CACHE and CACHE_DB: cache = Cache(CACHE_DB, CACHE_TTL, CACHE_SIZE)
+        trie = Trie(cache, CACHE_TTL) if CACHE else None
+        if SERVE:
+            asyncio.run(serve(SERVE, CONCURRENCY or IRR_DEPTH, trie))
+
+        elif DB:
+            index = Index(DB)
+            for q in queries(names):
+                if q[1] is None: report(q, None)
+                else: report(q, index.lookup(str2id(q[2]), q[3], width(q[2])))
+
+        elif ONESHOT:
+            plan = Plan(queries(names))
+            for q in plan.queries:
+                for a in plan.answer(q, lookup(q[2])): report(*a)
+            for a in plan.answered(): report(*a)
+
+        elif CONCURRENCY > 0:
+            asyncio.run(areport(names, trie))
 
-        if VERBOSE:
-            print('name: %s [%s], route: %s, origin: %s' %
-                  (ip_str, net, best[0]['route'][0], ass))
         else:
-            print(ip_str, net, best[0]['route'][0], ass)
+            plan = Plan(queries(names), trie and AGGREGATE)
+            whois = Whois(RA_SERVER, RA_SERVICE)
+            for q, rvs in lookups(plan.queries, whois, trie, plan.blocks):
+                for a in plan.answer(q, rvs): report(*a)
+            for a in plan.answered(): report(*a)
+            whois.close()
+
+    except socket.error as error:
+        if len(error.args) == 1:
+            err = 0
+            msg = error.args
+            sys.stderr.write('error: %s\n' % (" ".join(msg),))
+        else:
+            (err, msg) = error.args
+            sys.stderr.write('%s: %s\n' % (os.strerror(err), msg))
+
+        sys.exit(1)
+
+    finally:
+        if cache: cache.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2020 Richard Mortier <mort@cantab.net>. All Rights Reserved.
+#
+# Licensed under the GPL v3; see LICENSE.md in the root of this distribution or
+# the full text at https://opensource.org/licenses/GPL-3.0
+
+# Benchmarks `pcap_bw.py` over TRACES, by default a set generated with
+# `pcap_gen.py`, for each engine and number of jobs. Each run is a separate
+# process, reporting packets/s and MB/s from its `--stats`, the peak RSS of it
+# or any worker, and wall-clock time per window output at the finest window
+# size; the best of REPEAT runs is reported, as
+# CSV in the style of `pcap_bw.py`, eg.,
+#
+# $ pcap_bench.py -e python,numpy -j 1,4 > before.csv
+#   ... change the reader or accounting loop ...
+# $ pcap_bench.py -e python,numpy -j 1,4 > after.csv
+
+import sys, os, json, argparse, subprocess, tempfile, time, glob
+import pcap_gen
+
+PCAP_BW = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pcap_bw.py")
+
+## name: pcap_gen.generate() arguments; sized to take seconds, not minutes
+TRACES = {
+    "sll-4":       dict(hosts=4, duration=60, rate=10000),
+    "sll-256":     dict(hosts=256, duration=60, rate=10000),
+    "eth-4":       dict(hosts=4, duration=60, rate=10000,
+                        linktype=pcap_gen.LINKTYPES["eth"]),
+    "sll-4-noisy": dict(hosts=4, duration=60, rate=10000, arp=0.2, ipv6=0.2),
+}
+
+def generate(path, **kwargs):
+    with open(path, 'wb') as f:
+        return pcap_gen.generate(f, **kwargs)
+
+## runs pcap_bw.py once, returning its stats record extended with peak RSS [MB]
+## and seconds per window output
+def run(trace, engine, jobs, args, tmp):
+    out = os.path.join(tmp, "out-{window}.csv")
+    stats = os.path.join(tmp, "stats.json")
+    cmd = [ sys.executable, PCAP_BW, "-e", engine, "-j", str(jobs),
+            "-o", out, "--stats", stats ] + args + [ trace ]
+    t = time.time()
+    proc = subprocess.Popen(cmd, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    secs = time.time() - t
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    with open(stats) as f: r = json.load(f)
+    windows = 0
+    for path in glob.glob(out.format(window="*")):
+        with open(path) as f:
+            windows = max(windows, sum(1 for l in f if not l.startswith("#")))
+        os.remove(path)
+    r['maxrss'] = rusage.ru_maxrss / 1024 ## Linux reports kB
+    r['per_window'] = secs / windows if windows else 0
+    r['secs'] = secs
+    return r
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description="Benchmark pcap_bw.py over synthetic or given traces.")
+    p.add_argument('-e', '--engines', dest="ENGINES", default="python",
+                   help="Comma separated engines to run, eg., python,numpy")
+    p.add_argument('-j', '--jobs', dest="JOBS", default="1",
+                   help="Comma separated numbers of jobs to run, eg., 1,4")
+    p.add_argument('-r', '--repeat', dest="REPEAT", default=3, type=int,
+                   help="Runs of each configuration, reporting the fastest")
+    p.add_argument('-a', '--args', dest="ARGS", default="",
+                   help="Further pcap_bw.py arguments, eg., \"-w 1,10,60\"")
+    p.add_argument('-k', '--keep', dest="KEEP", default=None,
+                   help="Directory in which to keep, and reuse, generated"
+                   " traces")
+    p.add_argument('TRACES', nargs='*', default=[],
+                   help="PCAP files to analyse; if none, generated")
+    args = p.parse_args()
+
+    ENGINES = args.ENGINES.split(",")
+    JOBS = [ int(j) for j in args.JOBS.split(",") ]
+    ARGS = args.ARGS.split()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        traces = args.TRACES
+        if not traces:
+            d = args.KEEP or tmp
+            os.makedirs(d, exist_ok=True)
+            for name, kwargs in TRACES.items():
+                path = os.path.join(d, name + ".pcap")
+                if not os.path.exists(path):
+                    print("generating %s..." % path, file=sys.stderr)
+                    generate(path, **kwargs)
+                traces.append(path)
+
+        print("# trace, engine, jobs, packets, MB, secs, packets/s, MB/s,"
+              " maxrss MB, ms/window", flush=True)
+        for trace in traces:
+            for engine in ENGINES:
+                for jobs in JOBS:
+                    r = min((run(trace, engine, jobs, ARGS, tmp)
+                             for _ in range(args.REPEAT)),
+                            key=lambda r: r['secs'])
+                    print("%s, %s, %d, %d, %.1f, %.3f, %d, %.1f, %.1f, %.3f" % (
+                        os.path.basename(trace), engine, jobs, r['packets'],
+                        r['bytes'] / 1e6, r['secs'], r['packets_per_sec'],
+                        r['mb_per_sec'], r['maxrss'], r['per_window'] * 1000
+                    ), flush=True)
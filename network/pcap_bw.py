@@ -6,29 +6,632 @@
 # the full text at https://opensource.org/licenses/GPL-3.0
 
 # Computes total and all (src, dst) pairs bandwidth given a PCAP trace.
-# Currently assumes a "cooked Linux" (SLL) format trace captured using `tcpdump
-# -i any` from a mininet simulation.
+# Typically a "cooked Linux" (SLL) format trace captured using `tcpdump -i any`
+# from a mininet simulation; SLL2, Ethernet (including VLAN tagged) and raw IP
+# traces are also decoded directly, with dpkt handling anything unusual.
 #
-# Requires `pip|pip3 install dpkt`.
+# Requires `pip|pip3 install dpkt`. The vectorised `--engine numpy` and binary
+# `--format npz` output also require `pip|pip3 install numpy`; load the latter
+# with `pcap_bw.load()`.
 #
-# Useful pre-processing command lines for large PCAP files include:
+# Large traces can be analysed in parallel with `--jobs N`, which shards INPUT
+# into byte ranges aligned on record boundaries. Rather than slicing them with,
+# eg.,
 #
 # $ editcap -S0 -d -A"YYYY-MM-DD HH:mm:SS" -B"YYYY-MM-DD HH:mm:SS" in.pcap \
 #     fragment.pcap
+#
+# use `--from "YYYY-MM-DD HH:mm:SS" --to ...`, which builds a sparse timestamp
+# index INPUT.idx on first use and thereafter seeks straight to the range.
+#
+# Traces compressed with gzip, xz or bzip2 are detected by magic number and
+# decompressed on the fly, eg., `pcap_bw.py trace.pcap.xz`. Several INPUTs, eg.,
+# one capture per interface, are merged by timestamp as if by `mergecap`.
+#
+# Progress, throughput and dropped packets, by reason, are summarised on stderr
+# periodically, and as a JSON record at the end (or to `--stats FILE`).
 
-import sys, socket, pprint, json, argparse
+import sys, os, socket, pprint, json, argparse, mmap, struct, multiprocessing
+import select, time, heapq, copy, math, bisect, datetime, collections
+import threading, queue, zlib, lzma, bz2, contextlib, stat, array
 import dpkt
 
-## dpkt.pcap.Reader iterator doesn't provide the PCAP header, only the timestamp
-class R(dpkt.pcap.Reader):
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+## PCAP file magic numbers: microsecond and nanosecond timestamp resolution, in
+## either byte order
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+PCAP_FILEHDR_LEN = 24
+PCAP_PKTHDR_LEN  = 16
+
+## a candidate record header at an arbitrary byte offset is accepted only if
+## SYNC_RECORDS consecutive headers from it are plausible, or they run exactly
+## to the end of the file
+PCAP_MAX_LEN = 0x40000
+SYNC_RECORDS = 8
+SYNC_SECS    = 3600
+
+## zero-copy reader: maps the file and yields (ts, caplen, wirelen, buf) where
+## buf is a memoryview into the mapping, so a pass over the trace costs one
+## page-fault stream and no per-packet copies
+class Reader:
+    def __init__(self, f):
+        self._f = f
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self._mm[:4]
+        if magic not in PCAP_MAGIC or len(self._mm) < PCAP_FILEHDR_LEN:
+            self._mm.close()
+            raise ValueError("invalid pcap header")
+
+        self._endian, self._divisor = PCAP_MAGIC[magic]
+        self._pkthdr = struct.Struct(self._endian + 'IIII')
+        (self.version_major, self.version_minor, self.thiszone, self.sigfigs,
+         self.snaplen, self.linktype) = struct.unpack_from(
+             self._endian + 'HHiIII', self._mm, 4)
+        self.select()
+
+    ## restrict iteration to records starting in [start, stop) with
+    ## timestamps in [tmin, tmax)
+    def select(self, start=PCAP_FILEHDR_LEN, stop=None,
+               tmin=-math.inf, tmax=math.inf):
+        self.start = start
+        self.stop = len(self._mm) if stop is None else stop
+        self.tmin = tmin
+        self.tmax = tmax
+        self._timed = tmin > -math.inf or tmax < math.inf
+
     def __iter__(self):
+        return self.records()
+
+    ## records whose headers start in [start, stop)
+    def records(self, start=None, stop=None):
+        mm = self._mm
+        mv = memoryview(mm)
+        end = len(mm)
+        if start is None: start = self.start
+        if stop is None: stop = self.stop
+        unpack = self._pkthdr.unpack_from
+        divisor = self._divisor
+        timed, tmin, tmax = self._timed, self.tmin, self.tmax
+        off = start
+        try:
+            while off < stop and off + PCAP_PKTHDR_LEN <= end:
+                sec, frac, caplen, wirelen = unpack(mm, off)
+                off += PCAP_PKTHDR_LEN
+                if off + caplen > end: break ## truncated final record
+                ts = sec + frac / divisor
+                if not timed or tmin <= ts < tmax:
+                    yield (ts, caplen, wirelen, mv[off:off+caplen])
+                off += caplen
+        finally:
+            mv.release()
+
+    ## walk record headers only, yielding lists of up to n data offsets; the
+    ## numpy engine gathers header and packet fields itself
+    def offsets(self, n, start=None, stop=None):
+        mm = self._mm
+        end = len(mm)
+        if start is None: start = self.start
+        if stop is None: stop = self.stop
+        unpack = self._pkthdr.unpack_from
+        caplen_at = struct.Struct(self._endian + 'I').unpack_from
+        divisor = self._divisor
+        timed, tmin, tmax = self._timed, self.tmin, self.tmax
+        off = start
+        offs = []
+        append = offs.append
+        while off < stop and off + PCAP_PKTHDR_LEN <= end:
+            if timed:
+                sec, frac, caplen, _ = unpack(mm, off)
+                keep = tmin <= sec + frac / divisor < tmax
+            else:
+                caplen, = caplen_at(mm, off + 8)
+                keep = True
+            off += PCAP_PKTHDR_LEN
+            if off + caplen > end: break
+            if keep: append(off)
+            off += caplen
+            if len(offs) == n:
+                yield offs
+                offs = []
+                append = offs.append
+        if offs: yield offs
+
+    ## whether the SYNC_RECORDS headers chained from off look like records
+    def _chain(self, off):
+        mm = self._mm
+        end = len(mm)
+        unpack = self._pkthdr.unpack_from
+        snaplen = self.snaplen or PCAP_MAX_LEN
+        sec0 = None
+        for _ in range(SYNC_RECORDS):
+            if off == end: return True
+            if off + PCAP_PKTHDR_LEN > end: return False
+            sec, frac, caplen, wirelen = unpack(mm, off)
+            if sec0 is None: sec0 = sec
+            if (frac >= self._divisor or caplen > wirelen or caplen > snaplen
+                or not 0 < wirelen <= PCAP_MAX_LEN  ## not zero padding
+                or abs(sec - sec0) > SYNC_SECS):
+                return False
+            off += PCAP_PKTHDR_LEN + caplen
+            if off > end: return True ## truncated final record
+        return True
+
+    ## offset of the first record header at or after off
+    def sync(self, off):
+        end = len(self._mm)
+        off = max(off, PCAP_FILEHDR_LEN)
+        while off < end:
+            if self._chain(off): return off
+            off += 1
+        return end
+
+    ## split the selected range into n byte ranges that start on record
+    ## boundaries
+    def shards(self, n):
+        span = self.stop - self.start
+        starts = [self.start]
+        for i in range(1, n):
+            s = self.sync(self.start + span * i // n)
+            if starts[-1] < s < self.stop: starts.append(s)
+        return list(zip(starts, starts[1:] + [self.stop]))
+
+    def close(self):
+        self._mm.close()
+
+## sparse timestamp index, kept next to the trace as INPUT.idx, so that time
+## ranges can be read without scanning or rewriting the whole file. Every
+## INDEX_STRIDE records it holds the record offset, the latest timestamp of any
+## earlier record and the earliest of any record from there on, so both are
+## monotonic despite slightly out-of-order traces and can be binary searched.
+## The trace's size, modification time and first record header identify it
+INDEX_MAGIC  = b'PCAPBWI2'
+INDEX_STRIDE = 4096
+_INDEX_HDR   = struct.Struct('<8sQq16sI') ## magic, pcap file size, mtime [ns],
+                                          ## first record header, entries
+_INDEX_ENTRY = struct.Struct('<Qdd') ## offset, earlier max ts, later min ts
+
+class Index:
+    def __init__(self, trace, entries):
+        self.trace = trace
+        self.offsets = [ e[0] for e in entries ]
+        self.before = [ e[1] for e in entries ]
+        self.after = [ e[2] for e in entries ]
+
+    ## (size, mtime, first record header) of the trace pcap reads
+    @staticmethod
+    def identify(pcap):
+        mm = pcap._mm
+        return (len(mm), os.fstat(pcap._f.fileno()).st_mtime_ns,
+                mm[PCAP_FILEHDR_LEN:PCAP_FILEHDR_LEN + PCAP_PKTHDR_LEN])
+
+    @classmethod
+    def build(cls, pcap, stride=INDEX_STRIDE):
+        mm = pcap._mm
+        end = len(mm)
+        unpack = pcap._pkthdr.unpack_from
+        divisor = pcap._divisor
+        offs, tss = [], []
+        tmax = -math.inf
+        before = []
+        off, n = PCAP_FILEHDR_LEN, 0
+        while off + PCAP_PKTHDR_LEN <= end:
+            sec, frac, caplen, _ = unpack(mm, off)
+            if off + PCAP_PKTHDR_LEN + caplen > end: break
+            ts = sec + frac / divisor
+            if n % stride == 0:
+                offs.append(off)
+                before.append(tmax)
+                tss.append(ts)
+            elif ts < tss[-1]:
+                tss[-1] = ts
+            tmax = max(tmax, ts)
+            off += PCAP_PKTHDR_LEN + caplen
+            n += 1
+
+        ## tss holds the minimum of each stride; make it a suffix minimum
+        after = tss + [math.inf]
+        for i in range(len(tss) - 1, -1, -1):
+            after[i] = min(after[i], after[i+1])
+        return cls(cls.identify(pcap),
+                   list(zip(offs + [off], before + [tmax], after)))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(_INDEX_HDR.pack(INDEX_MAGIC, *self.trace,
+                                    len(self.offsets)))
+            for e in zip(self.offsets, self.before, self.after):
+                f.write(_INDEX_ENTRY.pack(*e))
+
+    ## the index at path if it describes the trace identified, else None
+    @classmethod
+    def load(cls, path, trace):
+        try:
+            with open(path, 'rb') as f: buf = f.read()
+        except OSError:
+            return None
+        if len(buf) < _INDEX_HDR.size: return None
+        magic, *itrace, n = _INDEX_HDR.unpack_from(buf)
+        if (magic != INDEX_MAGIC or tuple(itrace) != tuple(trace)
+            or len(buf) != _INDEX_HDR.size + n * _INDEX_ENTRY.size):
+            return None
+        return cls(trace,
+                   list(_INDEX_ENTRY.iter_unpack(buf[_INDEX_HDR.size:])))
+
+    ## byte range holding every record with timestamp in [tmin, tmax)
+    def range(self, tmin, tmax):
+        i = max(bisect.bisect_left(self.before, tmin) - 1, 0)
+        j = bisect.bisect_left(self.after, tmax)
+        return self.offsets[i], self.offsets[max(i, j)]
+
+## parse --from/--to: seconds since the epoch, or local "YYYY-MM-DD HH:MM:SS"
+def timestamp(s):
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(s).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("bad timestamp: %s" % s)
+
+## reader for a pcap stream, pulling data from read(timeout), which returns
+## bytes, b'' at EOF or None on timeout. Live, eg., `tcpdump -U -w - |
+## pcap_bw.py -`, data is read in STREAM_BUFSZ batches, holding at most one
+## batch plus a partial record, and a clock tick (now - STREAM_GRACE, 0, 0,
+## None) is yielded whenever no data arrives for STREAM_TICK seconds so that
+## windows can be closed by time; without -U, tcpdump buffers its output and
+## packets may arrive after their window has been closed
+STREAM_BUFSZ = 1 << 16
+STREAM_TICK  = 0.5 ## seconds
+STREAM_GRACE = 1.0 ## seconds
+
+def pipe(f):
+    fd = f.fileno()
+    def read(timeout):
+        r, _, _ = select.select([fd], [], [], timeout)
+        if not r: return None
+        return os.read(fd, STREAM_BUFSZ)
+    return read
+
+## as pipe(), for an INPUT that is not a regular file and so cannot be mapped,
+## eg., `pcap_bw.py <(cat trace.pcap)`; reads block rather than time out
+def stream(f):
+    def read(timeout):
+        return f.read1(STREAM_BUFSZ)
+    return read
+
+class StreamReader:
+    def __init__(self, read):
+        self._read = read
+        self._buf = bytearray()
+        while len(self._buf) < PCAP_FILEHDR_LEN:
+            if not self._fill(None): break
+        magic = bytes(self._buf[:4])
+        if magic not in PCAP_MAGIC or len(self._buf) < PCAP_FILEHDR_LEN:
+            raise ValueError("invalid pcap header")
+
+        self._endian, self._divisor = PCAP_MAGIC[magic]
+        self._pkthdr = struct.Struct(self._endian + 'IIII')
+        (self.version_major, self.version_minor, self.thiszone, self.sigfigs,
+         self.snaplen, self.linktype) = struct.unpack_from(
+             self._endian + 'HHiIII', self._buf, 4)
+        del self._buf[:PCAP_FILEHDR_LEN]
+
+    ## True if data was read, False at EOF, None on timeout
+    def _fill(self, timeout):
+        data = self._read(timeout)
+        if data is None: return None
+        if not data: return False
+        self._buf += data
+        return True
+
+    def __iter__(self):
+        buf = self._buf
+        unpack = self._pkthdr.unpack_from
+        divisor = self._divisor
         while 1:
-            buf = self._Reader__f.read(dpkt.pcap.PktHdr.__hdr_len__)
-            if not buf:
-                break
-            hdr = self._Reader__ph(buf)
-            buf = self._Reader__f.read(hdr.caplen)
-            yield (hdr.tv_sec + (hdr.tv_usec / self._divisor), hdr, buf)
+            off = 0
+            while len(buf) - off >= PCAP_PKTHDR_LEN:
+                sec, frac, caplen, wirelen = unpack(buf, off)
+                if len(buf) - off - PCAP_PKTHDR_LEN < caplen: break
+                off += PCAP_PKTHDR_LEN
+                yield (sec + frac / divisor, caplen, wirelen,
+                       bytes(buf[off:off+caplen]))
+                off += caplen
+            del buf[:off]
+
+            filled = self._fill(STREAM_TICK)
+            if filled is False: break
+            if filled is None: yield (time.time() - STREAM_GRACE, 0, 0, None)
+
+## compressed traces, detected by magic number, are decompressed by a
+## background thread into a bounded queue of large buffers. zlib, lzma and bz2
+## release the GIL while decompressing, so this overlaps with, and runs on a
+## different core from, the accounting. Input that is truncated or fails to
+## decompress ends the stream with an EOFError naming it
+COMPRESSED_MAGIC = {
+    b'\x1f\x8b':           lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    b'\xfd7zXZ\x00':       lzma.LZMADecompressor,
+    b'BZh':                bz2.BZ2Decompressor,
+}
+DECOMP_BUFSZ = 1 << 18 ## compressed bytes per read
+DECOMP_OUTSZ = 1 << 20 ## most decompressed bytes per buffer
+DECOMP_QUEUE = 16      ## decompressed buffers in flight
+
+## peeks, so that f may be a pipe, eg., `pcap_bw.py <(cat trace.pcap.gz)`
+def compression(f):
+    head = f.peek(6)[:6]
+    for magic, decompressor in COMPRESSED_MAGIC.items():
+        if head.startswith(magic): return decompressor
+    return None
+
+class Decompressor:
+    def __init__(self, f, decompressor):
+        self._q = queue.Queue(DECOMP_QUEUE)
+        self._t = threading.Thread(
+            target=self._run, args=(f, decompressor), daemon=True)
+        self._t.start()
+
+    def _run(self, f, decompressor):
+        try:
+            d, fed = decompressor(), False
+            while 1:
+                data = f.read(DECOMP_BUFSZ)
+                if not data: break
+                ## bounded output, so input left over is in zlib's
+                ## unconsumed_tail, or held by lzma and bz2 until needs_input
+                while 1:
+                    out = d.decompress(data, DECOMP_OUTSZ)
+                    fed = True
+                    if out: self._q.put(out)
+                    if d.eof: ## concatenated streams, eg., multi-member gzip
+                        data = d.unused_data
+                        d, fed = decompressor(), False
+                        if not data: break
+                    elif hasattr(d, 'unconsumed_tail'):
+                        data = d.unconsumed_tail
+                        if not data and len(out) < DECOMP_OUTSZ: break
+                    else:
+                        data = b''
+                        if d.needs_input: break
+            if fed: raise EOFError("truncated compressed input")
+            self._q.put(b'')
+        except Exception as e:
+            self._q.put(EOFError("%s: %s" % (f.name, e)))
+
+    ## as pipe(), but the queue never times out
+    def read(self, timeout):
+        data = self._q.get()
+        if isinstance(data, Exception): raise data
+        return data
+
+## time-ordered k-way merge of several traces, eg., one capture per mininet
+## interface, holding one record per input on a heap; ties go to the earlier
+## input, as with `mergecap`
+def merge(pcaps):
+    return heapq.merge(*pcaps, key=lambda r: r[0])
+
+## link-layer decoding, dispatched on the pcap linktype: fixed-offset decoders
+## map a frame to (ethtype, pkttype, offset of the network header), or None for
+## frames left to dpkt; pkttype is the SLL packet type, taken as
+## PACKET_OTHERHOST where the link layer has none
+LINKTYPE_ETHERNET  = 1
+LINKTYPE_RAW       = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETH_P_IP   = 0x0800
+ETH_P_ARP  = 0x0806
+ETH_P_IPV6 = 0x86dd
+VLAN_TPIDS = (0x8100, 0x88a8, 0x9100)
+
+PACKET_OTHERHOST = 3 ## sent to someone else
+PACKET_OUTGOING  = 4 ## sent by us, ie., emitted from switch
+
+SLL_HDR_LEN  = 16
+SLL2_HDR_LEN = 20
+ETH_HDR_LEN  = 14
+IP_HDR_LEN   = 20
+
+_SLL  = struct.Struct('>H12xH')
+_SLL2 = struct.Struct('>H8xB')
+_BE16 = struct.Struct('>H')
+_IP   = struct.Struct('>2xH8x4s4s') ## total length, src, dst
+
+def link_sll(buf):
+    if len(buf) < SLL_HDR_LEN: return None
+    pkttype, ethtype = _SLL.unpack_from(buf)
+    return ethtype, pkttype, SLL_HDR_LEN
+
+def link_sll2(buf):
+    if len(buf) < SLL2_HDR_LEN: return None
+    ethtype, pkttype = _SLL2.unpack_from(buf)
+    return ethtype, pkttype, SLL2_HDR_LEN
+
+def link_ethernet(buf):
+    off = ETH_HDR_LEN
+    if len(buf) < off: return None
+    ethtype, = _BE16.unpack_from(buf, off - 2)
+    while ethtype in VLAN_TPIDS:
+        off += 4
+        if len(buf) < off: return None
+        ethtype, = _BE16.unpack_from(buf, off - 2)
+    if ethtype < 0x0600: return None ## 802.3 length field, eg., LLC/SNAP
+    return ethtype, PACKET_OTHERHOST, off
+
+def link_raw(buf):
+    if len(buf) < 1: return None
+    version = buf[0] >> 4
+    if version == 4: return ETH_P_IP, PACKET_OTHERHOST, 0
+    if version == 6: return ETH_P_IPV6, PACKET_OTHERHOST, 0
+    return None
+
+LINK_DECODERS = {
+    LINKTYPE_ETHERNET:   link_ethernet,
+    LINKTYPE_RAW:        link_raw,
+    LINKTYPE_LINUX_SLL:  link_sll,
+    LINKTYPE_LINUX_SLL2: link_sll2,
+}
+
+## dpkt fallbacks, as (ethtype, pkttype, network layer object)
+def dpkt_sll(buf):
+    sll = dpkt.sll.SLL(buf)
+    return sll.ethtype, sll.type, sll.data
+
+def dpkt_sll2(buf):
+    sll = dpkt.sll2.SLL2(buf)
+    return sll.ethtype, sll.type, sll.data
+
+def dpkt_ethernet(buf):
+    eth = dpkt.ethernet.Ethernet(buf)
+    return eth.type, PACKET_OTHERHOST, eth.data
+
+def dpkt_raw(buf):
+    if buf[:1] and buf[0] >> 4 == 6:
+        return ETH_P_IPV6, PACKET_OTHERHOST, dpkt.ip6.IP6(buf)
+    return ETH_P_IP, PACKET_OTHERHOST, dpkt.ip.IP(buf)
+
+DPKT_DECODERS = {
+    LINKTYPE_ETHERNET:   dpkt_ethernet,
+    LINKTYPE_RAW:        dpkt_raw,
+    LINKTYPE_LINUX_SLL:  dpkt_sll,
+}
+if hasattr(dpkt, 'sll2'): DPKT_DECODERS[LINKTYPE_LINUX_SLL2] = dpkt_sll2
+
+## returns a function mapping a frame to (ethtype, pkttype, iplen, src, dst),
+## with the IPv4 fields None for anything else, or to None if the frame cannot
+## be decoded at all
+def decoder(linktype):
+    link = LINK_DECODERS.get(linktype)
+    fallback = DPKT_DECODERS.get(linktype)
+    if link is None and fallback is None:
+        raise ValueError("unsupported linktype %d" % linktype)
+
+    def decode(buf):
+        d = link(buf) if link else None
+        if d is not None:
+            ethtype, pkttype, off = d
+            if ethtype != ETH_P_IP:
+                return ethtype, pkttype, None, None, None
+            if len(buf) >= off + IP_HDR_LEN and buf[off] >> 4 == 4:
+                return (ethtype, pkttype) + _IP.unpack_from(buf, off)
+
+        try:
+            ethtype, pkttype, ip = fallback(bytes(buf))
+        except (dpkt.UnpackError, TypeError):
+            return None
+        if ethtype != ETH_P_IP:
+            return ethtype, pkttype, None, None, None
+        if not isinstance(ip, dpkt.ip.IP):
+            return None ## dpkt leaves undecodable payloads as bytes
+        return ethtype, pkttype, ip.len, ip.src, ip.dst
+
+    return decode
+
+## flows are keyed on (proto, src, sport, dst, dport) packed into a single int:
+## each endpoint is (addr << 16 | port) with addresses of either family in 128
+## bits, and the source endpoint also carries the family and protocol above
+FLOW_EP_BITS  = 144
+FLOW_EP_MASK  = (1 << FLOW_EP_BITS) - 1
+FLOW_IDLE     = 60 ## seconds
+IP6_HDR_LEN   = 40
+IP6_EXT_HDRS  = (0, 43, 44, 51, 60) ## hbh, routing, fragment, AH, dstopts
+IPPROTO_NAMES = { 1: 'icmp', 6: 'tcp', 17: 'udp', 58: 'icmp6', 132: 'sctp' }
+
+_IP4   = struct.Struct('>BxHxxHxB2xII') ## ver/ihl, len, frag, proto, src, dst
+_IP6   = struct.Struct('>4xHBx16s16s')  ## payload length, next, src, dst
+_PORTS = struct.Struct('>HH')
+
+def _flow_endpoints(fam, proto, src, sport, dst, dport):
+    return ((((fam << 8) | proto) << FLOW_EP_BITS) | (src << 16) | sport,
+            (dst << 16) | dport)
+
+## IPv4 or IPv6 packet at off as (length, src, dst) flow endpoints, or None if
+## the headers are incomplete
+def _flow_ip(buf, off, ethtype):
+    n = len(buf)
+    if ethtype == ETH_P_IP:
+        if n < off + IP_HDR_LEN or buf[off] >> 4 != 4: return None
+        vihl, iplen, frag, proto, src, dst = _IP4.unpack_from(buf, off)
+        fam, nxt, frag = 4, off + (vihl & 0x0f) * 4, frag & 0x1fff
+    else:
+        if n < off + IP6_HDR_LEN or buf[off] >> 4 != 6: return None
+        plen, proto, src, dst = _IP6.unpack_from(buf, off)
+        iplen = IP6_HDR_LEN + plen
+        src, dst = int.from_bytes(src, 'big'), int.from_bytes(dst, 'big')
+        fam, nxt, frag = 6, off + IP6_HDR_LEN, 0
+        while proto in IP6_EXT_HDRS:
+            if n < nxt + 8: return None
+            if proto == 44:
+                frag = _BE16.unpack_from(buf, nxt + 2)[0] & 0xfff8
+                hlen = 8
+            elif proto == 51:
+                hlen = (buf[nxt + 1] + 2) * 4
+            else:
+                hlen = (buf[nxt + 1] + 1) * 8
+            proto = buf[nxt]
+            nxt += hlen
+
+    sport = dport = 0
+    if proto in (6, 17) and not frag and n >= nxt + 4:
+        sport, dport = _PORTS.unpack_from(buf, nxt)
+    return (iplen,) + _flow_endpoints(fam, proto, src, sport, dst, dport)
+
+## as decoder(), but for IPv4 and IPv6 with src and dst being flow endpoints
+def flow_decoder(linktype):
+    link = LINK_DECODERS.get(linktype)
+    fallback = DPKT_DECODERS.get(linktype)
+    if link is None and fallback is None:
+        raise ValueError("unsupported linktype %d" % linktype)
+
+    def decode(buf):
+        d = link(buf) if link else None
+        if d is not None:
+            ethtype, pkttype, off = d
+            if ethtype != ETH_P_IP and ethtype != ETH_P_IPV6:
+                return ethtype, pkttype, None, None, None
+            f = _flow_ip(buf, off, ethtype)
+            if f is not None: return (ethtype, pkttype) + f
+
+        try:
+            ethtype, pkttype, ip = fallback(bytes(buf))
+        except (dpkt.UnpackError, TypeError):
+            return None
+        if ethtype != ETH_P_IP and ethtype != ETH_P_IPV6:
+            return ethtype, pkttype, None, None, None
+        if isinstance(ip, dpkt.ip.IP):
+            fam, iplen = 4, ip.len
+        elif isinstance(ip, dpkt.ip6.IP6):
+            fam, iplen = 6, IP6_HDR_LEN + ip.plen
+        else:
+            return None
+        sport = dport = 0
+        if isinstance(ip.data, (dpkt.tcp.TCP, dpkt.udp.UDP)):
+            sport, dport = ip.data.sport, ip.data.dport
+        return (ethtype, pkttype, iplen) + _flow_endpoints(
+            fam, ip.p, int.from_bytes(ip.src, 'big'), sport,
+            int.from_bytes(ip.dst, 'big'), dport)
+
+    return decode
+
+def flow_to_str(k):
+    src, dst = k >> FLOW_EP_BITS, k & FLOW_EP_MASK
+    fam, proto = src >> (FLOW_EP_BITS + 8), (src >> FLOW_EP_BITS) & 0xff
+    def ep(e):
+        addr, port = (e & FLOW_EP_MASK) >> 16, e & 0xffff
+        if fam == 4:
+            return "%s:%d" % (inet_to_str(addr.to_bytes(4, 'big')), port)
+        return "[%s]:%d" % (inet_to_str(addr.to_bytes(16, 'big')), port)
+    return "%s %s>%s" % (IPPROTO_NAMES.get(proto, str(proto)), ep(src), ep(dst))
 
 ## from dpkt print_pcap example
 def inet_to_str(inet):
@@ -37,73 +640,901 @@ def inet_to_str(inet):
     except ValueError:
         return socket.inet_ntop(socket.AF_INET6, inet)
 
-if __name__ == '__main__':
-    p = argparse.ArgumentParser(
-        description="Compute bandwidth from a PCAP file.")
-    p.add_argument('INPUT', help="PCAP file to analyse")
-    p.add_argument('-w', '--window', dest="WINDOW", default=1, type=int,
-                   help="Window size for bandwidth averaging [seconds]")
-    p.add_argument('HOSTS', default=[],
-                   help="Hosts to calculate bandwith usage between", nargs='*')
-    args = p.parse_args()
+## per-window (src, dst) accounting over the given HOSTS, counts being rows of
+## per-destination bytes in HOSTS order
+class HostMatrix:
+    def __init__(self, HOSTS):
+        self.HOSTS = HOSTS
+        self._hosts = [ socket.inet_aton(h) for h in HOSTS ]
+        self.reset()
 
-    INPUT  = args.INPUT
-    WINDOW = args.WINDOW ## seconds
-    HOSTS  = args.HOSTS
+    def reset(self, now=None):
+        self._bw = { i: { j: 0 for j in self._hosts } for i in self._hosts }
 
-    with open(INPUT, 'rb') as f:
-        pcap = R(f)
-        cnt = 0
-        prevts = 0
-        prevwindow = 0
-        totbw  = 0
-        hostbw = { i: { j: 0 for j in HOSTS } for i in HOSTS }
-        for ts, hdr, buf in pcap:
-            if prevts == 0:
-                s = ", ".join(
-                    ",".join([":".join([s,d]) for d in HOSTS])
-                    for s in HOSTS
-                )
-                print("# time, totalbw, %s" % s, sep=",", flush=True)
-            cnt += 1
-            if cnt % 10000 == 0:
-                print(cnt, "...", end="", sep="", flush=True, file=sys.stderr)
-
-            sll = dpkt.sll.SLL(buf) ## i happen to know the input linktype = SLL
-
-            pkt = None
-            if sll.ethtype == 0x0800: ## IPv4
-                if sll.type == 3: ## sent to someone else
-                    pkt = sll.ip
-                elif sll.type == 4: ## sent by us, ie., emitted from switch
-                    pass
-                else:
-                    print("[dropped %04x / %d]..." % (sll.ethtype, sll.type),
-                          end="", sep="", file=sys.stderr)
-            elif sll.ethtype == 0x0806: ## ARP
-                print("[dropped ARP / %d bytes]..." % hdr.len,
-                      end="", sep="", file=sys.stderr)
+    def add(self, src, dst, n):
+        try:
+            self._bw[src][dst] += n
+        except KeyError as e:
+            raise KeyError(inet_to_str(e.args[0])) from None
+
+    def counts(self):
+        return [ [ self._bw[s][d] for d in self._hosts ] for s in self._hosts ]
+
+## ...or over hosts discovered from the trace: addresses are interned to dense
+## ids and only active pairs kept, so a window costs O(active pairs) to reset
+## and print however many hosts there are; counts map (src, dst) to bytes
+class PairTable:
+    def __init__(self):
+        self._ids = {}
+        self._addrs = []
+        self.reset()
+
+    def reset(self, now=None):
+        self._pairs = {}
+
+    def intern(self, addr):
+        i = self._ids.get(addr)
+        if i is None:
+            i = self._ids[addr] = len(self._addrs)
+            self._addrs.append(addr)
+        return i
+
+    def add(self, src, dst, n):
+        k = (self.intern(src) << 32) | self.intern(dst)
+        self._pairs[k] = self._pairs.get(k, 0) + n
+
+    def counts(self):
+        addrs = self._addrs
+        return { (addrs[k >> 32], addrs[k & 0xffffffff]): n
+                 for k, n in self._pairs.items() }
+
+## Space-Saving summary of weighted keys in bounded memory: at most capacity
+## counters, each (count, err) with count - err <= true weight <= count; any key
+## not held has true weight <= floor(). The min-heap holds one entry per key,
+## refreshed lazily since counts only grow
+class SpaceSaving:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self._c = {}
+        self._heap = []
+
+    def add(self, key, n):
+        self.total += n
+        c = self._c.get(key)
+        if c is not None:
+            c[0] += n
+            return
+        if len(self._c) < self.capacity:
+            self._c[key] = [n, 0]
+            heapq.heappush(self._heap, (n, key))
+            return
+
+        heap = self._heap
+        while 1:
+            m, k = heap[0]
+            count = self._c[k][0]
+            if count == m: break
+            heapq.heapreplace(heap, (count, k))
+        heapq.heapreplace(heap, (m + n, key))
+        del self._c[k]
+        self._c[key] = [m + n, m]
+
+    def floor(self):
+        if len(self._c) < self.capacity: return 0
+        return min(c[0] for c in self._c.values())
+
+    def top(self, k):
+        return sorted(((key, c[0], c[1]) for key, c in self._c.items()),
+                      key=lambda t: (-t[1], t[0]))[:k]
+
+    ## summary of the union of both streams, per Agarwal et al., "Mergeable
+    ## Summaries": keys missing from one side may have up to its floor there
+    def merged(self, other):
+        fa, fb = self.floor(), other.floor()
+        c = { k: [ n + fb, e + fb ] for k, (n, e) in self._c.items() }
+        for k, (n, e) in other._c.items():
+            if k in c:
+                c[k][0] += n - fb
+                c[k][1] += e - fb
             else:
-                print("[dropped %04x / %d]..." % (sll.ethtype, sll.type),
-                      end="", sep="", file=sys.stderr)
+                c[k] = [ n + fa, e + fa ]
+
+        r = SpaceSaving(self.capacity)
+        r.total = self.total + other.total
+        keep = heapq.nlargest(self.capacity, c.items(), key=lambda kv: kv[1][0])
+        r._c = dict(keep)
+        r._heap = [ (n, k) for k, (n, e) in keep ]
+        heapq.heapify(r._heap)
+        return r
+
+## ...used for approximate accounting of the top K talkers and (src, dst) pairs
+## per window, in memory bounded by capacity whatever the number of hosts
+class TopK:
+    def __init__(self, k, capacity):
+        self.k = k
+        self.capacity = max(k, capacity)
+        self.reset()
+
+    def reset(self, now=None):
+        self.talkers = SpaceSaving(self.capacity)
+        self.pairs = SpaceSaving(self.capacity)
+
+    def add(self, src, dst, n):
+        self.talkers.add(src, n)
+        self.pairs.add(src + dst, n)
+
+    ## reset() replaces the summaries, so a shallow copy is a snapshot
+    def counts(self):
+        return copy.copy(self)
+
+    def merged(self, other):
+        r = copy.copy(self)
+        r.talkers = self.talkers.merged(other.talkers)
+        r.pairs = self.pairs.merged(other.pairs)
+        return r
+
+## per-flow accounting: flows are kept in least recently seen order, so those
+## idle for longer than idle seconds are evicted from the front as each window
+## closes, bounding memory on long traces of short-lived flows; counts map flow
+## keys to (bytes, packets) for the flows active in the window
+class FlowCounts(dict):
+    pass
+
+class FlowTable:
+    def __init__(self, idle=FLOW_IDLE):
+        self.idle = idle
+        self._flows = collections.OrderedDict() ## key: [bytes, pkts, last seen]
+        self._active = []
+        self._clock = 0
+
+    def reset(self, now=None):
+        flows = self._flows
+        for k in self._active:
+            f = flows[k]
+            f[0] = f[1] = 0
+        self._active = []
+        if now is None: return
+
+        self._clock = now
+        while flows:
+            k, f = next(iter(flows.items()))
+            if f[2] >= now - self.idle: break
+            del flows[k]
+
+    def add(self, src, dst, n):
+        k = (src << FLOW_EP_BITS) | dst
+        f = self._flows.get(k)
+        if f is None:
+            f = self._flows[k] = [0, 0, self._clock]
+        else:
+            self._flows.move_to_end(k)
+        if f[1] == 0: self._active.append(k)
+        f[0] += n
+        f[1] += 1
+        f[2] = self._clock
+
+    def counts(self):
+        flows = self._flows
+        return FlowCounts((k, (flows[k][0], flows[k][1])) for k in self._active)
+
+    def __len__(self):
+        return len(self._flows)
+
+def add_counts(a, b):
+    if isinstance(a, TopK):
+        return a.merged(b)
+    if isinstance(a, FlowCounts):
+        c = FlowCounts(a)
+        for k, (n, m) in b.items():
+            o = c.get(k, (0, 0))
+            c[k] = (o[0] + n, o[1] + m)
+        return c
+    if isinstance(a, dict):
+        c = dict(a)
+        for k, n in b.items(): c[k] = c.get(k, 0) + n
+        return c
+    return [ [ x + y for x, y in zip(ra, rb) ] for ra, rb in zip(a, b) ]
 
-            if not pkt: continue
+def print_header(HOSTS, file=sys.stdout, top=None, idle=None):
+    if idle is not None:
+        print("# time, totalbw, proto src:sport>dst:dport=bytes/pkts...",
+              file=file, flush=True)
+        return
+    if top:
+        print("# time, totalbw, talkerr, pairerr, %d x talker=bw~err,"
+              " %d x src:dst=bw~err" % (top[0], top[0]), file=file, flush=True)
+        return
+    if not HOSTS:
+        print("# time, totalbw, src:dst=bw...", file=file, flush=True)
+        return
+    s = ", ".join(
+        ",".join([":".join([s,d]) for d in HOSTS])
+        for s in HOSTS
+    )
+    print("# time, totalbw, %s" % s, sep=",", file=file, flush=True)
+
+def print_window(window, totbw, counts, file=sys.stdout):
+    if isinstance(counts, FlowCounts):
+        hostbws = ", ".join(
+            "%s=%d/%d" % ((flow_to_str(k),) + counts[k])
+            for k in sorted(counts))
+    elif isinstance(counts, TopK):
+        hostbws = ", ".join(
+            [ str(counts.talkers.floor()), str(counts.pairs.floor()) ]
+            + [ "%s=%d~%d" % (inet_to_str(s), n, e)
+                for s, n, e in counts.talkers.top(counts.k) ]
+            + [ "%s:%s=%d~%d" % (inet_to_str(sd[:4]), inet_to_str(sd[4:]), n, e)
+                for sd, n, e in counts.pairs.top(counts.k) ])
+    elif isinstance(counts, dict):
+        hostbws = ", ".join(
+            "%s:%s=%d" % (inet_to_str(s), inet_to_str(d), counts[s, d])
+            for s, d in sorted(counts))
+    else:
+        hostbws = ", ".join(",".join(map(str, row)) for row in counts)
+    print(window, totbw, hostbws, sep=", ", file=file, flush=True)
+
+## binary columnar output, buffered and written in bulk on close as a .npz of
+## little-endian arrays: `time` and `totalbw` hold one entry per window; with
+## HOSTS, `hosts` names the rows/columns of `bw[window, src, dst]`, otherwise
+## active pairs are held sparsely as parallel arrays `pair_window` (an index
+## into `time`), `src` and `dst` (IPv4 addresses as uint32) and `bw`. Columns
+## are buffered as packed machine integers, so memory stays near the size of
+## the arrays written
+class NpzWriter:
+    def __init__(self, path, HOSTS):
+        self.path = path
+        self.HOSTS = HOSTS
+        self._time = array.array('q')
+        self._totbw = array.array('q')
+        self._bw = array.array('q')
+        self._pairs = (array.array('q'), array.array('I'),
+                       array.array('I'), array.array('q'))
+
+    def write(self, window, totbw, counts):
+        if self.HOSTS:
+            self._bw.frombytes(np.asarray(counts, dtype=np.int64).tobytes())
+        else:
+            pw, src, dst, bw = self._pairs
+            n = len(self._time)
+            for (s, d), c in counts.items():
+                pw.append(n)
+                src.append(int.from_bytes(s, 'big'))
+                dst.append(int.from_bytes(d, 'big'))
+                bw.append(c)
+        self._time.append(window)
+        self._totbw.append(totbw)
+
+    def close(self):
+        H = len(self.HOSTS)
+        def column(a, dtype):
+            return np.frombuffer(a, dtype=a.typecode).astype(dtype)
+        arrays = {
+            'time': column(self._time, '<i8'),
+            'totalbw': column(self._totbw, '<i8'),
+        }
+        if self.HOSTS:
+            arrays['hosts'] = np.array(self.HOSTS, dtype=str)
+            arrays['bw'] = column(self._bw, '<i8').reshape(-1, H, H)
+        else:
+            pw, src, dst, bw = self._pairs
+            arrays['pair_window'] = column(pw, '<i8')
+            arrays['src'] = column(src, '<u4')
+            arrays['dst'] = column(dst, '<u4')
+            arrays['bw'] = column(bw, '<i8')
+        with open(self.path, 'wb') as f:
+            np.savez(f, **arrays)
+
+## ...loaded back as a dict of arrays, ready for plotting
+def load(path):
+    with np.load(path) as npz:
+        return { k: npz[k] for k in npz.files }
+
+## the engines below yield runs, (window, totbw, counts), of consecutive
+## accepted packets falling in the same window, including the final, open, run;
+## run statistics: packets and captured bytes read, and packets dropped by
+## reason. Engines batch their updates, every STATS_EVERY packets, at which
+## point a summary line is written if STATS_INTERVAL seconds have passed
+STATS_EVERY    = 1 << 16 ## packets
+STATS_INTERVAL = 10      ## seconds
+
+def drop_reason(ethtype, pkttype, accept):
+    if ethtype in accept:
+        if pkttype == PACKET_OTHERHOST: return None
+        if pkttype == PACKET_OUTGOING: return "outgoing"
+        return "pkttype"
+    if ethtype == ETH_P_ARP: return "arp"
+    return "ethertype"
+
+class Stats:
+    def __init__(self, file=None, interval=STATS_INTERVAL):
+        self.file = file
+        self.interval = interval
+        self.packets = 0
+        self.bytes = 0
+        self.drops = collections.Counter()
+        self.start = self._last = time.time()
+
+    def add(self, packets, nbytes):
+        self.packets += packets
+        self.bytes += nbytes
+
+    ## fold in a worker's counts
+    def merge(self, other):
+        self.add(other.packets, other.bytes)
+        self.drops.update(other.drops)
+
+    def tick(self):
+        now = time.time()
+        if self.file is not None and now - self._last >= self.interval:
+            self._last = now
+            r = self.record(now)
+            print("%d packets, %.1f MB in %.1fs: %d packets/s, %.1f MB/s%s" % (
+                r['packets'], r['bytes'] / 1e6, r['secs'], r['packets_per_sec'],
+                r['mb_per_sec'], "; dropped " + ", ".join(
+                    "%s=%d" % d for d in sorted(r['drops'].items()))
+                if r['drops'] else ""), file=self.file, flush=True)
+
+    def record(self, now=None):
+        secs = (time.time() if now is None else now) - self.start
+        return {
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'drops': dict(self.drops),
+            'secs': round(secs, 3),
+            'packets_per_sec': round(self.packets / secs) if secs else 0,
+            'mb_per_sec': round(self.bytes / 1e6 / secs, 3) if secs else 0,
+        }
+
+## with no HOSTS, hosts are discovered from the trace, or with top = (K,
+## capacity) only the top K are tracked approximately, or given an idle timeout
+## IPv4 and IPv6 flows are tracked instead
+def accumulator(HOSTS, top=None, idle=None):
+    if idle is not None: return FlowTable(idle)
+    if HOSTS: return HostMatrix(HOSTS)
+    if top: return TopK(*top)
+    return PairTable()
+
+## per-packet accounting; records may include StreamReader clock ticks, which
+## close the open window once the clock has passed it. Live, without a final
+## run, a window once closed, or passed by the clock, stays closed, later
+## packets for it being dropped as late rather than printing it again; and
+## each tick is passed on as (window, None, None) for coarser windows to close
+## by the clock too
+def runs_python(records, WINDOW, HOSTS, linktype=LINKTYPE_LINUX_SLL,
+                final=True, top=None, idle=None, stats=None):
+    if idle is not None:
+        decode = flow_decoder(linktype)
+        accept = (ETH_P_IP, ETH_P_IPV6)
+    else:
+        decode = decoder(linktype)
+        accept = (ETH_P_IP,)
+    hostbw = accumulator(HOSTS, top, idle)
+    if stats is None: stats = Stats()
+    drops = stats.drops
+    cnt = nbytes = 0
+    prevwindow = 0
+    closed = 0 ## the last window closed, when live
+    totbw  = 0
+    try:
+        for ts, caplen, wirelen, buf in records:
+            if buf is None:
+                stats.add(cnt, nbytes)
+                cnt = nbytes = 0
+                stats.tick()
+                window = WINDOW * (int(ts) // WINDOW)
+                if prevwindow != 0 and window > prevwindow:
+                    yield (prevwindow, totbw, hostbw.counts())
+                    totbw = 0
+                    hostbw.reset(window)
+                    prevwindow = 0
+                if not final:
+                    closed = max(closed, window - WINDOW)
+                    yield (window, None, None)
+                continue
+
+            cnt += 1
+            nbytes += caplen
+            if cnt == STATS_EVERY:
+                stats.add(cnt, nbytes)
+                cnt = nbytes = 0
+                stats.tick()
+
+            d = decode(buf)
+            if d is None:
+                drops["malformed"] += 1
+                continue
+
+            ethtype, pkttype, iplen, src, dst = d
+            if ethtype not in accept or pkttype != PACKET_OTHERHOST:
+                drops[drop_reason(ethtype, pkttype, accept)] += 1
+                continue
 
             window = int(ts) if WINDOW == 1 else WINDOW * (int(ts) // WINDOW)
-            if prevwindow == 0: prevwindow = window
+            if window <= closed:
+                drops["late"] += 1
+                continue
+            if prevwindow == 0:
+                prevwindow = window
+                hostbw.reset(window)
             if prevwindow != window:
-                hostbws = ", ".join(
-                    ",".join([ str(hostbw[s][d]) for d in HOSTS ])
-                     for s in HOSTS
-                )
-                print(prevwindow, totbw, hostbws, sep=", ", flush=True)
+                yield (prevwindow, totbw, hostbw.counts())
                 totbw = 0
-                hostbw = { i: { j: 0 for j in HOSTS } for i in HOSTS }
+                hostbw.reset(window)
+                if not final: closed = prevwindow
                 prevwindow = window
 
-            totbw += pkt.len
-            src = inet_to_str(pkt.src)
-            dst = inet_to_str(pkt.dst)
-            hostbw[src][dst] += pkt.len
+            totbw += iplen
+            hostbw.add(src, dst, iplen)
+
+        if final and prevwindow != 0:
+            yield (prevwindow, totbw, hostbw.counts())
+    finally:
+        stats.add(cnt, nbytes)
+
+## gather big-endian unsigned fields of the given width at byte offsets
+def _be(a, offs, width):
+    v = a[offs].astype(np.uint64)
+    for i in range(1, width):
+        v = (v << 8) | a[offs + i]
+    return v
+
+## ...and pcap header fields in the file's byte order
+def _u32(a, offs, endian):
+    v = _be(a, offs, 4)
+    if endian == '<':
+        v = ((v & 0xff) << 24) | ((v & 0xff00) << 8) \
+            | ((v >> 8) & 0xff00) | (v >> 24)
+    return v
+
+## vectorised link-layer decoding, mirroring LINK_DECODERS: returns ethtype,
+## pkttype and network header offset columns, and a mask of the frames they
+## decode; fields of the rest are garbage
+def _link_columns(a, offs, caplen, linktype):
+    n = len(offs)
+    pkttype = np.full(n, PACKET_OTHERHOST, dtype=np.uint64)
+    if linktype == LINKTYPE_LINUX_SLL:
+        fast = caplen >= SLL_HDR_LEN
+        o = np.where(fast, offs, 0)
+        pkttype = _be(a, o, 2)
+        ethtype = _be(a, o + 14, 2)
+        ipoff = np.full(n, SLL_HDR_LEN, dtype=np.int64)
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        fast = caplen >= SLL2_HDR_LEN
+        o = np.where(fast, offs, 0)
+        ethtype = _be(a, o, 2)
+        pkttype = _be(a, o + 10, 1)
+        ipoff = np.full(n, SLL2_HDR_LEN, dtype=np.int64)
+    elif linktype == LINKTYPE_ETHERNET:
+        fast = caplen >= ETH_HDR_LEN
+        o = np.where(fast, offs, 0)
+        ipoff = np.full(n, ETH_HDR_LEN, dtype=np.int64)
+        ethtype = _be(a, o + ipoff - 2, 2)
+        vlan = np.isin(ethtype, VLAN_TPIDS)
+        for _ in range(2): ## 802.1Q and QinQ; deeper stacks go to dpkt
+            if not vlan.any(): break
+            ipoff[vlan] += 4
+            fast &= ~vlan | (caplen >= ipoff)
+            o = np.where(fast, offs, 0)
+            ethtype[vlan] = _be(a, o[vlan] + ipoff[vlan] - 2, 2)
+            vlan &= np.isin(ethtype, VLAN_TPIDS)
+        fast &= ~vlan & (ethtype >= 0x0600)
+    elif linktype == LINKTYPE_RAW:
+        fast = caplen >= 1
+        o = np.where(fast, offs, 0)
+        version = a[o] >> 4
+        ethtype = np.where(version == 4, ETH_P_IP,
+                           np.where(version == 6, ETH_P_IPV6, 0))
+        fast &= (version == 4) | (version == 6)
+        ipoff = np.zeros(n, dtype=np.int64)
+    else:
+        return (np.zeros(n, dtype=np.uint64), pkttype,
+                np.zeros(n, dtype=np.int64), np.zeros(n, dtype=bool))
+
+    ## IPv4 headers must be complete for the fixed-offset path
+    ip = ethtype == ETH_P_IP
+    ip &= fast
+    fits = caplen >= ipoff + IP_HDR_LEN
+    fast &= ~ip | fits
+    ok = ip & fits
+    fast[ok] &= (a[offs[ok] + ipoff[ok]] >> 4) == 4
+    return ethtype, pkttype, ipoff, fast
+
+## vectorised accounting: scans the trace in chunks into columns (seconds, IPv4
+## src/dst as uint32, IP length) and sums runs of packets falling in the same
+## window with np.bincount
+CHUNK = 1 << 20
+
+def runs_numpy(pcap, WINDOW, HOSTS, chunk=CHUNK, top=None, stats=None):
+    a = np.frombuffer(pcap._mm, dtype=np.uint8)
+    mv = memoryview(pcap._mm)
+    decode = decoder(pcap.linktype)
+
+    if HOSTS:
+        ## HOSTS may repeat; account over the unique set and index back out
+        uhosts = sorted(set(HOSTS), key=lambda h: socket.inet_aton(h))
+        hids = np.array([ int.from_bytes(socket.inet_aton(h), 'big')
+                          for h in uhosts ], dtype=np.uint64)
+        cols = np.array([ uhosts.index(h) for h in HOSTS ], dtype=np.intp)
+        H = len(uhosts)
+        HH = H * H
+
+    def host_index(addrs):
+        i = np.searchsorted(hids, addrs)
+        bad = (i >= H) | (hids[np.minimum(i, H-1)] != addrs)
+        if bad.any():
+            raise KeyError(
+                inet_to_str(int(addrs[bad][0]).to_bytes(4, 'big')))
+        return i
+
+    def run(window, totbw, mat):
+        if not HOSTS: return (window, totbw, mat)
+        return (window, totbw, mat[cols][:, cols].tolist())
+
+    ## sparse per-run pair sums, as one {(src, dst): bytes} dict per run: pairs
+    ## in the chunk are interned to dense ids by np.unique
+    def pair_counts(runid, nruns, src, dst, iplen):
+        pairs, pid = np.unique((src << 32) | dst, return_inverse=True)
+        keys, kid = np.unique(runid * len(pairs) + pid, return_inverse=True)
+        sums = np.bincount(kid, weights=iplen).astype(np.int64)
+        runs = keys // len(pairs)
+        pairs = pairs[keys % len(pairs)]
+        bounds = np.searchsorted(runs, np.arange(nruns + 1))
+        return [ { (int(k >> 32).to_bytes(4, 'big'),
+                    int(k & 0xffffffff).to_bytes(4, 'big')): n
+                   for k, n in zip(pairs[lo:hi].tolist(),
+                                   sums[lo:hi].tolist()) }
+                 for lo, hi in zip(bounds[:-1], bounds[1:]) ]
+
+    if stats is None: stats = Stats()
+    drops = stats.drops
+    carry = None ## (window, totbw, matrix) of the run still open
+    for offs in pcap.offsets(chunk):
+        offs = np.array(offs, dtype=np.int64)
+        caplen = _u32(a, offs - 8, pcap._endian)
+        stats.add(len(offs), int(caplen.sum()))
+        ethtype, pkttype, ipoff, fast = _link_columns(
+            a, offs, caplen, pcap.linktype)
+        ip = fast & (ethtype == ETH_P_IP)
+        keep = ip & (pkttype == PACKET_OTHERHOST)
+        outgoing = ip & (pkttype == PACKET_OUTGOING)
+        arp = fast & (ethtype == ETH_P_ARP)
+        for reason, n in (
+                ("outgoing", outgoing.sum()),
+                ("pkttype", (ip & ~keep & ~outgoing).sum()),
+                ("arp", arp.sum()),
+                ("ethertype", (fast & ~ip & ~arp).sum())):
+            if n: drops[reason] += int(n)
+        ip = offs[keep] + ipoff[keep]
+        iplen = np.zeros(len(offs), dtype=np.int64)
+        src = np.zeros(len(offs), dtype=np.uint64)
+        dst = np.zeros(len(offs), dtype=np.uint64)
+        iplen[keep] = _be(a, ip + 2, 2)
+        src[keep] = _be(a, ip + 12, 4)
+        dst[keep] = _be(a, ip + 16, 4)
+
+        ## frames the fixed offsets can't handle go through the per-packet
+        ## decoder, in place so that packet order is kept
+        for i in np.flatnonzero(~fast).tolist():
+            o = int(offs[i])
+            d = decode(mv[o:o+int(caplen[i])])
+            reason = "malformed" if d is None \
+                else drop_reason(d[0], d[1], (ETH_P_IP,))
+            if reason:
+                drops[reason] += 1
+            else:
+                keep[i] = True
+                iplen[i] = d[2]
+                src[i] = int.from_bytes(d[3], 'big')
+                dst[i] = int.from_bytes(d[4], 'big')
+
+        stats.tick()
+        if not keep.any(): continue
+        secs = _u32(a, offs[keep] - PCAP_PKTHDR_LEN, pcap._endian)
+        iplen = iplen[keep]
+        src = src[keep]
+        dst = dst[keep]
+
+        windows = secs // WINDOW * WINDOW
+        change = np.empty(len(windows), dtype=bool)
+        change[0] = False
+        np.not_equal(windows[1:], windows[:-1], out=change[1:])
+        runid = np.cumsum(change)
+        nruns = int(runid[-1]) + 1
+        starts = windows[np.r_[0, np.flatnonzero(change)]]
+
+        tots = np.bincount(runid, weights=iplen, minlength=nruns)
+        tots = tots.astype(np.int64)
+        if HOSTS:
+            src = host_index(src)
+            dst = host_index(dst)
+            mats = np.bincount(runid * HH + src * H + dst, weights=iplen,
+                               minlength=nruns * HH).reshape(nruns, H, H)
+            mats = mats.astype(np.int64)
+        else:
+            mats = pair_counts(runid, nruns, src, dst, iplen)
+            if top:
+                for r, pairs in enumerate(mats):
+                    mats[r] = accumulator(HOSTS, top)
+                    for (s, d), n in pairs.items(): mats[r].add(s, d, n)
+
+        if carry is not None:
+            if carry[0] == starts[0]:
+                tots[0] += carry[1]
+                if HOSTS: mats[0] += carry[2]
+                else: mats[0] = add_counts(mats[0], carry[2])
+            else:
+                yield run(*carry)
+        for r in range(nruns - 1):
+            yield run(int(starts[r]), int(tots[r]), mats[r])
+        carry = (int(starts[-1]), int(tots[-1]), mats[-1])
+
+    if carry is not None:
+        yield run(*carry)
+
+## sums adjacent runs falling in the same WINDOW. This both stitches together
+## runs cut by a shard edge, which show up as adjacent runs with the same
+## window, and rolls finer runs up into coarser windows: a finer run lies within
+## a single coarser window, so rolling up gives exactly the coarser runs. Live,
+## clock ticks close the open run once the clock has passed its window, and are
+## passed on
+def merge_runs(runs, WINDOW=1, final=True):
+    prev = None
+    for w, totbw, counts in runs:
+        w = w if WINDOW == 1 else WINDOW * (w // WINDOW)
+        if totbw is None:
+            if prev is not None and w > prev[0]:
+                yield prev
+                prev = None
+            yield (w, None, None)
+            continue
+        if prev is not None and prev[0] == w:
+            prev = (w, prev[1] + totbw, add_counts(prev[2], counts))
+            continue
+        if prev is not None: yield prev
+        prev = (w, totbw, counts)
+    if final and prev is not None: yield prev
+
+## prints runs as they pass through. A window is printed once a later packet
+## crosses its boundary, so the final, partial, window is never printed;
+## whereas live, runs are only yielded once complete so each is printed, and
+## flushed, as it arrives, clock ticks passing through unprinted
+def print_runs(runs, HOSTS, file=sys.stdout, live=False, top=None, idle=None):
+    if isinstance(file, NpzWriter):
+        write = file.write
+    else:
+        print_header(HOSTS, file, top, idle)
+        write = lambda *r: print_window(*r, file=file)
+    prev = None
+    for r in runs:
+        if r[1] is not None:
+            if live: write(*r)
+            elif prev is not None: write(*prev)
+            prev = r
+        yield r
+
+## prints runs at the finest of WINDOWS to the first of outs, rolling them up
+## into each coarser window in turn
+def report(runs, WINDOWS, HOSTS, outs, live=False, top=None, idle=None):
+    for i, (WINDOW, out) in enumerate(zip(WINDOWS, outs)):
+        if i > 0: runs = merge_runs(runs, WINDOW, final=not live)
+        runs = print_runs(runs, HOSTS, out, live, top, idle)
+    for _ in runs: pass
+
+## a positive number of seconds
+def seconds(s):
+    n = int(s)
+    if n <= 0:
+        raise argparse.ArgumentTypeError("must be positive: %s" % s)
+    return n
+
+## comma separated window sizes, each a multiple of the last
+def windows(s):
+    ws = [ int(w) for w in s.split(',') ]
+    for i, w in enumerate(ws):
+        if w <= 0 or (i > 0 and w % ws[i-1]):
+            raise argparse.ArgumentTypeError(
+                "windows must increase, each a multiple of the last: %s" % s)
+    return ws
+
+## restrict pcap to [tmin, tmax) using the INPUT.idx index, building it if
+## missing, stale or rebuild is set; if it cannot be saved, eg., in a read-only
+## archive, it is used anyway
+def select_range(pcap, INPUT, rebuild, tmin, tmax):
+    trace = Index.identify(pcap)
+    index = None if rebuild else Index.load(INPUT + ".idx", trace)
+    if index is None:
+        index = Index.build(pcap)
+        try:
+            index.save(INPUT + ".idx")
+        except OSError as e:
+            print("%s.idx: not saved: %s" % (INPUT, e.strerror),
+                  file=sys.stderr)
+    start, stop = index.range(tmin, tmax)
+    pcap.select(start, stop, tmin, tmax)
+
+## trailing positionals that look like addresses, rather than files, are HOSTS
+def is_host(s):
+    try:
+        socket.inet_aton(s)
+    except OSError:
+        return False
+    return not os.path.exists(s)
+
+def runs_shard(job):
+    INPUT, ENGINE, WINDOW, HOSTS, TOP, IDLE, start, stop, tmin, tmax = job
+    stats = Stats()
+    with open(INPUT, 'rb') as f:
+        pcap = Reader(f)
+        pcap.select(start, stop, tmin, tmax)
+        if ENGINE == "numpy":
+            runs = list(runs_numpy(pcap, WINDOW, HOSTS, top=TOP, stats=stats))
+        else:
+            runs = list(runs_python(pcap, WINDOW, HOSTS, pcap.linktype,
+                                    top=TOP, idle=IDLE, stats=stats))
+    return runs, stats
+
+## workers' runs, in order, folding their statistics into stats
+def runs_shards(results, stats):
+    for runs, s in results:
+        stats.merge(s)
+        stats.tick()
+        yield from runs
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description="Compute bandwidth from a PCAP file.")
+    p.add_argument('INPUT', nargs='+',
+                   help="PCAP file(s) to analyse, several being merged by"
+                   " timestamp; - to stream stdin")
+    p.add_argument('-w', '--window', dest="WINDOWS", default=[1], type=windows,
+                   help="Window size(s) for bandwidth averaging [seconds], eg.,"
+                   " 1,10,60 to roll up several resolutions in one pass")
+    p.add_argument('-o', '--output', dest="OUTPUT", default=None,
+                   help="Output file per window size, {window} standing for"
+                   " the size; default stdout for a single window size")
+    p.add_argument('--flows', dest="FLOWS", action='store_true',
+                   help="Account per IPv4/IPv6 (proto, src, sport, dst, dport)"
+                   " flow instead of per host pair")
+    p.add_argument('--idle', dest="IDLE", default=FLOW_IDLE, type=seconds,
+                   help="Seconds after which idle flows are evicted")
+    p.add_argument('-f', '--format', dest="FORMAT", default="csv",
+                   choices=("csv", "npz"),
+                   help="Output format; npz writes binary columns, see load()")
+    p.add_argument('-k', '--top', dest="TOP", default=0, type=int,
+                   help="Approximate top K talkers and pairs per window in"
+                   " bounded memory, instead of all discovered hosts")
+    p.add_argument('--epsilon', dest="EPSILON", default=0.001, type=float,
+                   help="Top K error bound, as a fraction of window bytes")
+    p.add_argument('--from', dest="FROM", default=None, type=timestamp,
+                   help="Only packets at or after this time, as epoch seconds"
+                   " or local \"YYYY-MM-DD HH:MM:SS\"; uses INPUT.idx")
+    p.add_argument('--to', dest="TO", default=None, type=timestamp,
+                   help="Only packets before this time; uses INPUT.idx")
+    p.add_argument('--index', dest="INDEX", action='store_true',
+                   help="(Re)build the INPUT.idx timestamp index")
+    p.add_argument('--stats', dest="STATS", default=None,
+                   help="Write final run statistics as JSON to this file;"
+                   " default stderr")
+    p.add_argument('-e', '--engine', dest="ENGINE", default="python",
+                   choices=("python", "numpy"),
+                   help="Accounting engine; numpy is vectorised over chunks")
+    p.add_argument('-j', '--jobs', dest="JOBS", default=1, type=int,
+                   help="Worker processes, each analysing a shard of INPUT")
+    p.add_argument('HOSTS', default=[],
+                   help="Hosts to calculate bandwith usage between;"
+                   " if none, discovered from INPUT", nargs='*')
+    args = p.parse_args()
+    while len(args.INPUT) > 1 and is_host(args.INPUT[-1]):
+        args.HOSTS.insert(0, args.INPUT.pop())
+
+    INPUTS  = args.INPUT
+    INPUT   = INPUTS[0]
+    WINDOWS = args.WINDOWS ## seconds
+    WINDOW  = WINDOWS[0]
+    HOSTS   = args.HOSTS
+    ENGINE  = args.ENGINE
+    JOBS    = args.JOBS
+    OUTPUT  = args.OUTPUT
+    FORMAT  = args.FORMAT
+    TOP     = (args.TOP, math.ceil(1 / args.EPSILON)) if args.TOP else None
+    if ENGINE == "numpy" and np is None:
+        p.error("numpy engine requires `pip|pip3 install numpy`")
+    IDLE    = args.IDLE if args.FLOWS else None
+    TMIN    = -math.inf if args.FROM is None else args.FROM
+    TMAX    = math.inf if args.TO is None else args.TO
+    INDEXED = args.INDEX or TMIN > -math.inf or TMAX < math.inf
+    if len(INPUTS) > 1 and ("-" in INPUTS or ENGINE != "python" or JOBS > 1):
+        p.error("several INPUTs require files, the python engine and one job")
+    if INPUT == "-" and (ENGINE != "python" or JOBS > 1):
+        p.error("streaming stdin requires the python engine and one job")
+    if INPUT == "-" and INDEXED:
+        p.error("streaming stdin cannot be indexed")
+    if TOP and HOSTS:
+        p.error("--top applies only to discovered hosts")
+    if IDLE is not None and (
+            HOSTS or TOP or ENGINE != "python" or FORMAT != "csv"):
+        p.error("--flows excludes HOSTS, --top, --engine numpy and npz output")
+    if len(WINDOWS) > 1 and (OUTPUT is None or "{window}" not in OUTPUT):
+        p.error("several window sizes require --output with {window}")
+    ## each INPUT is opened once, as it may be a pipe
+    inputs = [] if INPUT == "-" else [ open(path, 'rb') for path in INPUTS ]
+    decompressors = [ compression(f) for f in inputs ] or [ None ]
+    streamed = [ bool(d) or not stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+                 for f, d in zip(inputs, decompressors) ]
+    if any(streamed) and (ENGINE != "python" or JOBS > 1):
+        p.error("compressed or piped INPUT requires the python engine and"
+                " one job")
+    if any(streamed) and INDEXED:
+        p.error("compressed or piped INPUT cannot be indexed")
+    if FORMAT == "npz" and (np is None or OUTPUT is None or TOP):
+        p.error("npz output requires numpy and --output, and excludes --top")
+
+    if FORMAT == "npz":
+        outs = [ NpzWriter(OUTPUT.format(window=w), HOSTS) for w in WINDOWS ]
+    elif OUTPUT is None:
+        outs = [ sys.stdout ]
+    else:
+        outs = [ open(OUTPUT.format(window=w), 'w') for w in WINDOWS ]
+    stats = Stats(sys.stderr)
+
+    if INPUT == "-":
+        pcap = StreamReader(pipe(sys.stdin.buffer))
+        try:
+            report(runs_python(pcap, WINDOW, HOSTS, pcap.linktype, final=False,
+                               top=TOP, idle=IDLE, stats=stats),
+                   WINDOWS, HOSTS, outs, live=True, top=TOP, idle=IDLE)
+        except KeyboardInterrupt:
+            pass
+
+    elif len(INPUTS) > 1 or any(streamed):
+        with contextlib.ExitStack() as stack:
+            try:
+                pcaps = []
+                for path, f, decompressor in zip(INPUTS, inputs, decompressors):
+                    f = stack.enter_context(f)
+                    if decompressor:
+                        pcap = StreamReader(Decompressor(f, decompressor).read)
+                    elif not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                        pcap = StreamReader(stream(f))
+                    else:
+                        pcap = Reader(f)
+                        if INDEXED:
+                            select_range(pcap, path, args.INDEX, TMIN, TMAX)
+                    pcaps.append(pcap)
+                linktype = pcaps[0].linktype
+                if any(pcap.linktype != linktype for pcap in pcaps):
+                    p.error("INPUTs must share a link type")
+                report(runs_python(merge(pcaps), WINDOW, HOSTS, linktype,
+                                   top=TOP, idle=IDLE, stats=stats),
+                       WINDOWS, HOSTS, outs, top=TOP, idle=IDLE)
+            except EOFError as e: ## a compressed INPUT ended early
+                print(e, file=sys.stderr)
+
+    else:
+        with inputs[0] as f:
+            pcap = Reader(f)
+            if INDEXED: select_range(pcap, INPUT, args.INDEX, TMIN, TMAX)
+
+            if JOBS > 1:
+                jobs = [ (INPUT, ENGINE, WINDOW, HOSTS, TOP, IDLE, start, stop,
+                          TMIN, TMAX)
+                         for start, stop in pcap.shards(JOBS) ]
+                with multiprocessing.Pool(len(jobs)) as pool:
+                    report(merge_runs(
+                        runs_shards(pool.imap(runs_shard, jobs), stats)
+                    ), WINDOWS, HOSTS, outs, top=TOP, idle=IDLE)
+            elif ENGINE == "numpy":
+                report(runs_numpy(pcap, WINDOW, HOSTS, top=TOP, stats=stats),
+                       WINDOWS, HOSTS, outs, top=TOP)
+            else:
+                report(runs_python(pcap, WINDOW, HOSTS, pcap.linktype,
+                                   top=TOP, idle=IDLE, stats=stats),
+                       WINDOWS, HOSTS, outs, top=TOP, idle=IDLE)
 
-            prevts = ts
+    for out in outs:
+        if out is not sys.stdout: out.close()
+    if args.STATS is None:
+        print(json.dumps(stats.record()), file=sys.stderr)
+    else:
+        with open(args.STATS, 'w') as f: json.dump(stats.record(), f)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2020 Richard Mortier <mort@cantab.net>. All Rights Reserved.
+#
+# Licensed under the GPL v3; see LICENSE.md in the root of this distribution or
+# the full text at https://opensource.org/licenses/GPL-3.0
+
+# Generates a synthetic PCAP trace, as if captured by `tcpdump -i any` (SLL) or
+# on an Ethernet interface, for reproducibly benchmarking `pcap_bw.py`. Packets
+# arrive as a Poisson process at RATE per second between HOSTS hosts,
+# 10.0.0.1 upwards, with IP lengths drawn from SIZES, plus a fraction of ARP,
+# IPv6 and outgoing (SLL packet type 4) noise.
+
+import sys, struct, random, argparse, socket
+
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPES = { "eth": 1, "sll": 113 }
+
+ETH_P_IP   = 0x0800
+ETH_P_ARP  = 0x0806
+ETH_P_IPV6 = 0x86dd
+PACKET_OTHERHOST = 3
+PACKET_OUTGOING  = 4
+
+T0 = 1600000000 ## start of trace, epoch seconds
+SNAPLEN = 262144 ## `tcpdump` default
+
+## simple IMIX: 7 small, 4 medium, 1 large
+IMIX = "40:7,576:4,1500:1"
+
+_PCAP_HDR = struct.Struct('<IHHiIII')
+_PKT_HDR  = struct.Struct('<IIII')
+_SLL      = struct.Struct('>HHH8sH')
+_ETH      = struct.Struct('>6s6sH')
+_IP       = struct.Struct('>BBHHHBBH4s4s')
+_IP6      = struct.Struct('>IHBB16s16s')
+_PORTS    = struct.Struct('>HH')
+
+## length:weight,... for the IP length distribution
+def sizes(s):
+    try:
+        ds = [ tuple(map(int, d.split(':'))) for d in s.split(',') ]
+        if all(20 + _PORTS.size <= n <= 0xffff and w > 0 for n, w in ds):
+            return ds
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(
+        "sizes must be LENGTH:WEIGHT,... with LENGTH at least 24: %s" % s)
+
+def frame(linktype, pkttype, ethtype, payload):
+    if linktype == LINKTYPES["sll"]:
+        return _SLL.pack(pkttype, 1, 6, b'\x02' * 8, ethtype) + payload
+    return _ETH.pack(b'\x02' * 6, b'\x02' * 6, ethtype) + payload
+
+## writes the trace to f, returning the number of packets written. Payloads are
+## zero and packets are captured up to snaplen bytes, as by `tcpdump -s`
+def generate(f, hosts=4, duration=60, rate=1000, dist=sizes(IMIX),
+             arp=0.01, ipv6=0.01, outgoing=0.3, linktype=LINKTYPES["sll"],
+             snaplen=SNAPLEN, seed=1):
+    r = random.Random(seed)
+    addrs = [ socket.inet_aton("10.0.%d.%d" % ((i+1) >> 8, (i+1) & 0xff))
+              for i in range(hosts) ]
+    addrs6 = [ b'\xfd' + b'\x00' * 11 + a for a in addrs ]
+    lengths = [ n for n, _ in dist ]
+    weights = [ w for _, w in dist ]
+
+    f.write(_PCAP_HDR.pack(PCAP_MAGIC, 2, 4, 0, 0, snaplen, linktype))
+    n = 0
+    ts = T0 + r.expovariate(rate)
+    while ts < T0 + duration:
+        kind = r.random()
+        pkttype = PACKET_OTHERHOST
+        src, dst = r.sample(range(hosts), 2)
+        iplen = r.choices(lengths, weights)[0]
+        if kind < arp:
+            ethtype = ETH_P_ARP
+            payload = struct.pack('>HHBBH6s4s6s4s', 1, ETH_P_IP, 6, 4, 1,
+                                  b'\x02' * 6, addrs[src],
+                                  b'\x00' * 6, addrs[dst])
+            iplen = len(payload)
+        elif kind < arp + ipv6:
+            ethtype = ETH_P_IPV6
+            iplen = max(iplen, _IP6.size + _PORTS.size)
+            payload = _IP6.pack(6 << 28, iplen - _IP6.size, 17, 64,
+                                addrs6[src], addrs6[dst])
+            payload += _PORTS.pack(r.randrange(1024, 65536), 53)
+        else:
+            ethtype = ETH_P_IP
+            if r.random() < outgoing: pkttype = PACKET_OUTGOING
+            proto = 6 if r.random() < 0.5 else 17
+            payload = _IP.pack(0x45, 0, iplen, n & 0xffff, 0, 64, proto, 0,
+                               addrs[src], addrs[dst])
+            payload += _PORTS.pack(r.randrange(1024, 65536),
+                                   r.choice((22, 53, 80, 443)))
+        payload += bytes(iplen - len(payload))
+        buf = frame(linktype, pkttype, ethtype, payload)
+        wirelen = len(buf)
+        buf = buf[:snaplen]
+
+        sec = int(ts)
+        f.write(_PKT_HDR.pack(sec, int((ts - sec) * 1000000), len(buf),
+                              wirelen))
+        f.write(buf)
+        n += 1
+        ts += r.expovariate(rate)
+    return n
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description="Generate a synthetic PCAP file for pcap_bw.py.")
+    p.add_argument('OUTPUT', help="PCAP file to write; - for stdout")
+    p.add_argument('-n', '--hosts', dest="HOSTS", default=4, type=int,
+                   help="Number of hosts, 10.0.0.1 upwards")
+    p.add_argument('-d', '--duration', dest="DURATION", default=60,
+                   type=float, help="Trace duration [seconds]")
+    p.add_argument('-r', '--rate', dest="RATE", default=1000, type=float,
+                   help="Mean packet rate [packets/second]")
+    p.add_argument('-s', '--sizes', dest="SIZES", default=IMIX, type=sizes,
+                   help="IP length distribution as LENGTH:WEIGHT,...;"
+                   " default simple IMIX %s" % IMIX)
+    p.add_argument('-l', '--linktype', dest="LINKTYPE", default="sll",
+                   choices=sorted(LINKTYPES),
+                   help="Link layer: Linux cooked (SLL) or Ethernet")
+    p.add_argument('--arp', dest="ARP", default=0.01, type=float,
+                   help="Fraction of ARP packets")
+    p.add_argument('--ipv6', dest="IPV6", default=0.01, type=float,
+                   help="Fraction of IPv6 packets")
+    p.add_argument('--outgoing', dest="OUTGOING", default=0.3, type=float,
+                   help="Fraction of IPv4 packets captured as outgoing;"
+                   " SLL only")
+    p.add_argument('--snaplen', dest="SNAPLEN", default=SNAPLEN, type=int,
+                   help="Bytes captured per packet, eg., 96 for headers only")
+    p.add_argument('--seed', dest="SEED", default=1, type=int,
+                   help="Random seed")
+    args = p.parse_args()
+    if args.HOSTS < 2:
+        p.error("at least two hosts are needed")
+
+    f = sys.stdout.buffer if args.OUTPUT == "-" else open(args.OUTPUT, 'wb')
+    n = generate(f, args.HOSTS, args.DURATION, args.RATE, args.SIZES,
+                 args.ARP, args.IPV6, args.OUTGOING,
+                 LINKTYPES[args.LINKTYPE], args.SNAPLEN, args.SEED)
+    if f is not sys.stdout.buffer: f.close()
+    print("%d packets" % n, file=sys.stderr)